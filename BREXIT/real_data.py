@@ -0,0 +1,136 @@
+"""
+Vectorised building blocks for social learning on real data: per-user signals binned over time, the follower
+combination matrix as a sparse array, and the divergence / error of the adaptive model over a grid of step sizes.
+Everything is linear in the number of tweets, edges and users, so the follower graph can be far larger than the
+UK-parliament list.
+"""
+import numpy as np
+from scipy import sparse
+
+
+def bin_signals(index, timestamps, values, starts, width=None, users=None, default=.5):
+    """
+    Mean of the values of every user in every time bin, carried forward over bins without values.
+    Bins are [starts[k], starts[k] + width), or [starts[k], starts[k + 1]) if width is None (the last one open).
+
+    :np.array index: user position (0 .. users - 1) of every value, e.g. np.repeat(np.arange(users), counts)
+    :np.array timestamps: time of every value, same unit as starts and width (e.g. ms from tweet_store)
+    :np.array values: e.g. tweet sentiments
+    :np.array starts: increasing bin starts
+    :width: bin length, None for contiguous bins
+    :int users: number of users, index.max() + 1 if None
+    :float default: belief before the first value of a user
+    :return: np.array(users, bins)
+    """
+    index = np.asarray(index, dtype=np.int64)
+    timestamps = np.asarray(timestamps)
+    starts = np.asarray(starts)
+    if users is None:
+        users = int(index.max()) + 1 if index.shape[0] else 0
+    bins = starts.shape[0]
+    position = np.searchsorted(starts, timestamps, side='right') - 1
+    valid = position >= 0
+    if width is not None:
+        valid &= timestamps < starts[np.maximum(position, 0)] + width
+    cell = index[valid] * bins + position[valid]
+    sums = np.bincount(cell, weights=np.asarray(values, dtype=float)[valid], minlength=users * bins)
+    counts = np.bincount(cell, minlength=users * bins)
+    sums, counts = sums.reshape(users, bins), counts.reshape(users, bins)
+
+    # forward fill: every bin reads the last bin with values at or before it
+    last = np.where(counts > 0, np.arange(bins), -1)
+    np.maximum.accumulate(last, axis=1, out=last)
+    rows = np.arange(users)[:, None]
+    means = sums / np.maximum(counts, 1)
+    return np.where(last >= 0, means[rows, np.maximum(last, 0)], default)
+
+
+def edges_from_dict(graph_dict):
+    """
+    :dict graph_dict: user id -> list of user ids, e.g. the loaded graph_dict.json (followed -> followers)
+    :return: np.array sources, np.array targets (int64 user ids) with an edge for every listed pair
+    """
+    lengths = [len(targets) for targets in graph_dict.values()]
+    sources = np.repeat(np.array([int(source) for source in graph_dict], dtype=np.int64), lengths)
+    targets = np.fromiter((int(target) for targets in graph_dict.values() for target in targets), dtype=np.int64,
+                          count=sum(lengths))
+    return sources, targets
+
+
+def index_of(ids, values):
+    """
+    :np.array ids: distinct user ids
+    :np.array values: user ids to look up
+    :return: np.array positions of values in ids, -1 for unknown ids
+    """
+    ids = np.asarray(ids)
+    values = np.asarray(values)
+    if ids.shape[0] == 0:
+        return np.full(values.shape, -1, dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    position = np.minimum(np.searchsorted(sorted_ids, values), ids.shape[0] - 1)
+    found = sorted_ids[position] == values
+    return np.where(found, order[position], -1)
+
+
+def follower_adjacency(sources, targets, ids):
+    """
+    :np.array sources, targets: user ids of the edges, entry [source, target] is set (duplicates count once)
+    :np.array ids: user ids in agent order, edges with other ids are dropped
+    :return: scipy.sparse.csr_matrix(agents, agents) 0/1 adjacency
+    """
+    rows, cols = index_of(ids, sources), index_of(ids, targets)
+    keep = (rows >= 0) & (cols >= 0)
+    agents = len(ids)
+    adjacency = sparse.csr_matrix((np.ones(int(keep.sum())), (rows[keep], cols[keep])), shape=(agents, agents))
+    adjacency.sum_duplicates()
+    adjacency.data[:] = 1
+    return adjacency
+
+
+def normalize_columns(matrix):
+    """
+    Left-stochastic normalisation, columns without any entry stay zero.
+    :matrix: scipy.sparse matrix or np.array
+    """
+    norm = np.asarray(matrix.sum(0)).reshape(-1)
+    norm[norm == 0] = 1
+    if sparse.issparse(matrix):
+        return (matrix @ sparse.diags(1 / norm)).tocsr()
+    return matrix / norm[None, :]
+
+
+def _betas(deltas):
+    deltas = np.asarray(deltas, dtype=float).reshape(-1)
+    return deltas, np.where(deltas == 0, 1., deltas)
+
+
+def get_divergence(beliefs, network, deltas):
+    """
+    mean_i (beliefs[i] - (1 - delta) network.T @ beliefs[i - 1]) / delta (no division for delta = 0),
+    for all deltas with a single product with network.
+    :np.array beliefs: times x agents
+    :network: agents x agents combination matrix, np.array or scipy.sparse
+    :deltas: step sizes
+    :return: np.array(len(deltas), agents)
+    """
+    beliefs = np.asarray(beliefs, dtype=float)
+    deltas, betas = _betas(deltas)
+    times = beliefs.shape[0]
+    current = beliefs[1:].sum(0)
+    previous = network.T @ beliefs[:-1].sum(0)
+    return (current[None, :] - (1 - deltas)[:, None] * previous[None, :]) / (times - 1) / betas[:, None]
+
+
+def get_error(beliefs, network, divergence, deltas):
+    """
+    || avg - (1 - delta) network.T @ avg - delta divergence || / agents with avg the time average of beliefs
+    (delta replaced by 1 in front of the divergence for delta = 0), for all deltas.
+    :np.array divergence: len(deltas) x agents, e.g. get_divergence on another part of the data
+    :return: np.array(len(deltas))
+    """
+    avg = np.asarray(beliefs, dtype=float).mean(0)
+    deltas, betas = _betas(deltas)
+    residual = avg[None, :] - (1 - deltas)[:, None] * (network.T @ avg)[None, :] - betas[:, None] * divergence
+    return np.linalg.norm(residual, axis=1) / avg.shape[0]
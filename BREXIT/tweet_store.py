@@ -0,0 +1,168 @@
+"""
+Columnar store of the per-user tweet files (one <user id>.json search response per user, e.g. data/tweets0104).
+
+    python tweet_store.py --data data/tweets0104 --out data/tweets0104.npz [--sentiments data/belifs_all_dict0104.json]
+
+Every tweet becomes a row of user id, tweet id, timestamp and sentiment, grouped by user in increasing user id.
+Files are parsed once with a process pool; later builds only reparse the files whose mtime or size changed, keep the
+rows (and the sentiments) of the other files and drop the rows of removed ones. Analysis code reads the arrays back
+with load_store, without any JSON parsing.
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+TWEPOCH = 1288834974657  # ms, epoch of the twitter snowflake ids
+
+
+def tweet_timestamps(tweet_ids):
+    """
+    :np.array tweet_ids: snowflake tweet ids
+    :return: np.array int64 creation times in ms since the unix epoch
+    """
+    return (np.asarray(tweet_ids, dtype=np.int64) >> 22) + TWEPOCH
+
+
+def _parse(task):
+    path, texts = task
+    with open(path) as f:
+        response = json.load(f)
+    # users without any matching tweet have no 'data'
+    tweets = response.get('data', []) if isinstance(response, dict) else []
+    ids = np.array([int(tweet['id']) for tweet in tweets], dtype=np.int64)
+    return ids, [tweet['text'] for tweet in tweets] if texts else None
+
+
+def _sentiments(sentiment, user, ids, texts):
+    if sentiment is None or ids.shape[0] == 0:
+        return np.full(ids.shape[0], np.nan)
+    if callable(sentiment):
+        scores = sentiment(texts)
+    else:
+        scores = sentiment.get(str(user), sentiment.get(user, [np.nan] * ids.shape[0]))
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    if scores.shape[0] != ids.shape[0]:
+        raise ValueError("Invalid number of sentiments for user {}.".format(user))
+    return scores
+
+
+def _scan(data_path):
+    files = {}
+    for entry in os.scandir(data_path):
+        if entry.is_file() and entry.name.endswith('.json'):
+            stat = entry.stat()
+            files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def build_store(data_path, store_path, sentiment=None, workers=None):
+    """
+    :str data_path: directory of <user id>.json files
+    :str store_path: npz file, updated incrementally if it exists
+    :sentiment: callable list of texts -> scores of one user (e.g. roberta_sent_anal.eval_sentences_positive),
+        dict user id -> list of scores (e.g. the loaded belifs_all_dict0104.json), or None to leave them nan;
+        only applied to new or changed files
+    :int workers: parsing processes, None for all cores, 0 or 1 to parse in this process
+    :return: dict of arrays, see load_store
+    """
+    files = _scan(data_path)
+    names = sorted(files, key=lambda name: int(name[:-5]))
+    old = load_store(store_path) if os.path.exists(store_path) else None
+    kept = {}
+    if old is not None:
+        for i, name in enumerate(old['files']):
+            if files.get(name) == (old['mtime'][i], old['size'][i]):
+                kept[name] = slice(old['offsets'][i], old['offsets'][i + 1])
+
+    todo = [name for name in names if name not in kept]
+    tasks = [(os.path.join(data_path, name), callable(sentiment)) for name in todo]
+    if workers in (0, 1) or len(tasks) < 2:
+        parsed = list(map(_parse, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = list(executor.map(_parse, tasks, chunksize=max(1, len(tasks) // 64)))
+    parsed = dict(zip(todo, parsed))
+
+    users = np.array([int(name[:-5]) for name in names], dtype=np.int64)
+    tweets, scores = [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+    for user, name in zip(users, names):
+        if name in kept:
+            tweets.append(old['tweet'][kept[name]])
+            scores.append(old['sentiment'][kept[name]])
+        else:
+            ids, texts = parsed[name]
+            tweets.append(ids)
+            scores.append(_sentiments(sentiment, user, ids, texts))
+    counts = np.array([ids.shape[0] for ids in tweets[1:]], dtype=np.int64)
+    tweet = np.concatenate(tweets)
+
+    store = {
+        'users': users,
+        'offsets': np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+        'user': np.repeat(users, counts),
+        'tweet': tweet,
+        'timestamp': tweet_timestamps(tweet),
+        'sentiment': np.concatenate(scores),
+        'files': np.array(names, dtype=str),
+        'mtime': np.array([files[name][0] for name in names], dtype=np.int64),
+        'size': np.array([files[name][1] for name in names], dtype=np.int64),
+    }
+    # write next to the target and rename, so an interrupted build never leaves a broken store
+    temporary = store_path + '.tmp'
+    with open(temporary, 'wb') as f:
+        np.savez(f, **store)
+    os.replace(temporary, store_path)
+    return store
+
+
+def load_store(store_path):
+    """
+    :str store_path: npz file written by build_store
+    :return: dict of arrays
+        'users': np.array(users) user ids in increasing order,
+        'offsets': np.array(users + 1), rows offsets[k]:offsets[k + 1] are the tweets of users[k],
+        'user', 'tweet', 'timestamp' (ms since the unix epoch), 'sentiment': np.array(tweets) columns,
+        'files', 'mtime', 'size': source files the rows were parsed from
+    """
+    with np.load(store_path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def user_columns(store, column):
+    """
+    :return: list with the values of `column` for every user, in the order of store['users']
+    """
+    return np.split(store[column], store['offsets'][1:-1])
+
+
+def user_means(store, column='sentiment', default=.5):
+    """
+    :return: np.array(users) mean of `column` per user, default for users without tweets
+    """
+    counts = np.diff(store['offsets'])
+    sums = np.bincount(np.repeat(np.arange(counts.shape[0]), counts), weights=store[column],
+                       minlength=counts.shape[0])
+    return np.where(counts > 0, sums / np.maximum(counts, 1), default)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default='data/tweets0104', help='directory of <user id>.json files')
+    parser.add_argument('--out', default='data/tweets0104.npz')
+    parser.add_argument('--sentiments', default=None, help='JSON dict user id -> list of sentiments to import')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    sentiment = None
+    if args.sentiments is not None:
+        with open(args.sentiments) as f:
+            sentiment = json.load(f)
+    store = build_store(args.data, args.out, sentiment=sentiment, workers=args.workers)
+    print('{} users, {} tweets -> {}'.format(store['users'].shape[0], store['tweet'].shape[0], args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+Timing benchmarks for the simulation, estimation and learning kernels.
+
+    python benchmark.py run --out baseline.json [--quick] [--filter step]
+    python benchmark.py compare baseline.json new.json [--threshold 0.2]
+
+run times every case (best of --repeat rounds, each round averaged over enough calls to last --min-time seconds)
+and saves a JSON baseline; compare flags cases that got slower than the baseline by more than the threshold and
+exits with status 1 if there are any. Everything runs offline on the CPU.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import scipy
+
+import optimization
+import utils
+from parallel import ParallelNetwork
+from social_learning import Network
+
+AGENTS = [30, 100, 300, 1000, 3000, 10000]
+AGENTS_QUICK = [30, 100, 300]
+STATES = [2, 10, 50]
+PARAMS = [2, 25]
+MAX_DENSE_AGENTS = 3000
+
+
+def _graph(agents, dense, rng):
+    clusters_agents = [agents // 2, agents - agents // 2]
+    degree = min(20., agents / 2)
+    probs = np.full((2, 2), .1 * degree / agents)
+    np.fill_diagonal(probs, 1.8 * degree / agents)
+    adj_matrix = utils.create_network(agents, 7, rng=rng, clusters_agents=clusters_agents, probs=probs)
+    if dense:
+        adj_matrix = adj_matrix.toarray()
+    return adj_matrix
+
+
+def _network(agents, states, params, dense, window, strategy=0, seed=0, dtype=None, log_ratios=False, workers=None):
+    rng = np.random.default_rng(seed)
+    adj_matrix = _graph(agents, dense, rng)
+    combination_matrix, _, _ = utils.generate_combination_weights(adj_matrix, 0)
+    likelihood = utils.create_likelihoods(agents, states, 1 if strategy == 0 else 2, params=params, rng=rng)
+    state_true = rng.integers(states, size=agents)
+    generator = utils.Generator(likelihood, state_true, strategy, rng=rng)
+    belief_init = np.ones((states, agents)) / states
+    if workers is not None:
+        return ParallelNetwork(agents, states, state_true, adj_matrix, combination_matrix, likelihood, generator,
+                               belief_init, step_size=.1, window=window, workers=workers,
+                               clusters_agents=[agents // 2, agents - agents // 2])
+    return Network(agents, states, state_true, adj_matrix, combination_matrix, likelihood, generator, belief_init,
+                   step_size=.1, window=window, dtype=dtype, log_ratios=log_ratios)
+
+
+def _case_step(agents, states, params, dense, window, strategy, dtype=None):
+    network = _network(agents, states, params, dense, window, strategy, dtype=dtype)
+    return network.step
+
+
+def _case_step_parallel(agents, states, workers):
+    network = _network(agents, states, 2, False, 1, workers=workers)
+    return network.step
+
+
+def _case_sample(agents, states, params):
+    network = _network(agents, states, params, False, 1)
+    return network.generator.sample
+
+
+def _case_kl_divergence(agents, states, params):
+    likelihood = utils.create_likelihoods(agents, states, 1, params=params, rng=np.random.default_rng(0))
+    state_true = np.zeros(agents, dtype=int)
+
+    def run():
+        utils._kl_tensor_cache.clear()
+        utils.kl_divergence(likelihood, 0, 1, option=0, state_true=state_true)
+    return run
+
+
+def _window_beliefs(agents, states, dense, window, log_ratios=False):
+    network = _network(agents, states, 2, dense, window + 1, log_ratios=log_ratios)
+    for _ in range(window + 1):
+        network.step()
+    return network
+
+
+def _case_kl_estimation(agents, states, dense, window):
+    network = _window_beliefs(agents, states, dense, window)
+    beliefs = list(network.intermediate_belief_history)
+    return lambda: optimization.kl_divergence_estimation(beliefs, network.C, network.step_size, window)
+
+
+def _case_kl_from_log_ratios(agents, states, dense, window):
+    network = _window_beliefs(agents, states, dense, window, log_ratios=True)
+    return lambda: optimization.kl_divergence_from_log_ratios(network.log_ratio_history[-window - 1:-1], network.C,
+                                                              network.step_size)
+
+
+def _case_optimization_step(agents, states):
+    network = _window_beliefs(agents, states, True, 2)
+    log_cur = optimization.log_belief_ratios(network.intermediate_belief_history[-1])
+    log_prev = optimization.log_belief_ratios(network.intermediate_belief_history[-2])
+    kl_div = np.zeros_like(log_cur)
+    combination_matrix = network.C
+
+    def run():
+        # adj / |adj| is nan on the zero entries of the sparse graph
+        with np.errstate(invalid='ignore'):
+            optimization.optimization_step(log_cur, log_prev, combination_matrix, kl_div, lr=1e-3,
+                                           step_size=network.step_size, multistate=True)
+    return run
+
+
+def _case_combination_weights(agents, dense, option):
+    adj_matrix = _graph(agents, dense, np.random.default_rng(0))
+    return lambda: utils.generate_combination_weights(adj_matrix, option)
+
+
+def _case_dynamic_graph(agents, dense, flips=10):
+    graph = utils.DynamicGraph(_graph(agents, dense, np.random.default_rng(0)), 0, rng=np.random.default_rng(1))
+    p_change = flips / (agents * (agents - 1) / 2)
+    return lambda: graph.perturbe(p_change)
+
+
+def _case_estimate_adjacency(agents):
+    adj_matrix = _graph(agents, True, np.random.default_rng(0))
+    combination_matrix, _, _ = utils.generate_combination_weights(adj_matrix, 0)
+    combination_matrix = combination_matrix + 1e-3 * np.random.default_rng(1).random(combination_matrix.shape)
+    return lambda: utils.estimate_adjacency_colwise(combination_matrix)
+
+
+def cases(quick=False):
+    """
+    :return: list of (name, factory) where factory() builds the inputs and returns the callable to time
+    """
+    agents_range = AGENTS_QUICK if quick else AGENTS
+    res = []
+    for agents in agents_range:
+        for dense in (True, False):
+            if dense and agents > MAX_DENSE_AGENTS:
+                continue
+            kind = 'dense' if dense else 'sparse'
+            for states in STATES:
+                for window in (None, 500):
+                    name = 'step[agents={},states={},{},window={}]'.format(agents, states, kind, window)
+                    res.append((name, lambda a=agents, s=states, d=dense, w=window: _case_step(a, s, 2, d, w, 0)))
+            for dtype in (np.float64, np.float32):
+                name = 'step_inplace[agents={},states=10,{},dtype={}]'.format(agents, kind, dtype.__name__)
+                res.append((name, lambda a=agents, d=dense, t=dtype: _case_step(a, 10, 2, d, None, 0, t)))
+            if not dense:
+                for workers in (2, 4):
+                    name = 'step_parallel[agents={},states=10,sparse,workers={}]'.format(agents, workers)
+                    res.append((name, lambda a=agents, w=workers: _case_step_parallel(a, 10, w)))
+            name = 'step_gaussian[agents={},states=2,{}]'.format(agents, kind)
+            res.append((name, lambda a=agents, d=dense: _case_step(a, 2, 2, d, 500, 2)))
+            for states in (2, 10):
+                name = 'kl_divergence_estimation[agents={},states={},{},window=100]'.format(agents, states, kind)
+                res.append((name, lambda a=agents, s=states, d=dense: _case_kl_estimation(a, s, d, 100)))
+                name = 'kl_divergence_from_log_ratios[agents={},states={},{},window=100]'.format(agents, states, kind)
+                res.append((name, lambda a=agents, s=states, d=dense: _case_kl_from_log_ratios(a, s, d, 100)))
+            for option in (0, 1):
+                name = 'generate_combination_weights[agents={},{},option={}]'.format(agents, kind, option)
+                res.append((name, lambda a=agents, d=dense, o=option: _case_combination_weights(a, d, o)))
+            name = 'dynamic_graph_perturbe[agents={},{},flips=10]'.format(agents, kind)
+            res.append((name, lambda a=agents, d=dense: _case_dynamic_graph(a, d)))
+        for states in STATES:
+            for params in PARAMS:
+                name = 'generator_sample[agents={},states={},params={}]'.format(agents, states, params)
+                res.append((name, lambda a=agents, s=states, p=params: _case_sample(a, s, p)))
+                name = 'kl_divergence[agents={},states={},params={}]'.format(agents, states, params)
+                res.append((name, lambda a=agents, s=states, p=params: _case_kl_divergence(a, s, p)))
+        if agents <= MAX_DENSE_AGENTS:
+            for states in (2, 10):
+                name = 'optimization_step[agents={},states={}]'.format(agents, states)
+                res.append((name, lambda a=agents, s=states: _case_optimization_step(a, s)))
+            name = 'estimate_adjacency_colwise[agents={}]'.format(agents)
+            res.append((name, lambda a=agents: _case_estimate_adjacency(a)))
+    return res
+
+
+def measure(function, repeat=5, min_time=.05):
+    """
+    :return: best over `repeat` rounds of the mean time per call, every round lasting at least min_time
+    """
+    function()
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        calls *= 2
+    best = elapsed / calls
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best
+
+
+def run(out, quick=False, name_filter=None, repeat=5, min_time=.05):
+    results = {}
+    for name, factory in cases(quick):
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = measure(factory(), repeat=repeat, min_time=min_time)
+        print('{:80s} {:12.3e} s'.format(name, results[name]), flush=True)
+    baseline = {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    with open(out, 'w') as f:
+        json.dump(baseline, f, indent=1)
+    return baseline
+
+
+def compare(baseline, current, threshold=.2):
+    """
+    :return: list of (name, baseline seconds, current seconds, ratio) for cases slower by more than threshold
+    """
+    with open(baseline) as f:
+        old = json.load(f)['results']
+    with open(current) as f:
+        new = json.load(f)['results']
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        ratio = new[name] / old[name]
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append((name, old[name], new[name], ratio))
+            flag = '  SLOWER'
+        print('{:80s} {:10.3e} -> {:10.3e} s  x{:.2f}{}'.format(name, old[name], new[name], ratio, flag))
+    for name in sorted(set(old) ^ set(new)):
+        print('{:80s} only in {}'.format(name, baseline if name in old else current))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_run = subparsers.add_parser('run', help='time all cases and save a baseline')
+    parser_run.add_argument('--out', default='benchmark.json')
+    parser_run.add_argument('--quick', action='store_true', help='only the small agent counts')
+    parser_run.add_argument('--filter', default=None, help='only cases whose name contains this string')
+    parser_run.add_argument('--repeat', type=int, default=5)
+    parser_run.add_argument('--min-time', type=float, default=.05)
+    parser_compare = subparsers.add_parser('compare', help='flag slowdowns against a baseline')
+    parser_compare.add_argument('baseline')
+    parser_compare.add_argument('current')
+    parser_compare.add_argument('--threshold', type=float, default=.2, help='allowed relative slowdown')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        run(args.out, quick=args.quick, name_filter=args.filter, repeat=args.repeat, min_time=args.min_time)
+        return 0
+    regressions = compare(args.baseline, args.current, threshold=args.threshold)
+    if regressions:
+        print('{} case(s) slower than the baseline by more than {:.0%}'.format(len(regressions), args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class History():
+    def __init__(self, window=None, capacity=1024):
+        """
+        Time-ordered store of equally shaped arrays (beliefs, observations).
+        With a window the frames live in a preallocated mirrored ring buffer of size 2 x window: every
+        frame is written twice, so the last `window` frames are always one contiguous slice and
+        appending costs the same for any window. Without a window the buffer grows by doubling.
+        Indexing and slicing return read-only zero-copy views (negative indices count from the newest
+        frame); a view of a slot is only valid until the ring overwrites it, copy it to keep it.
+
+        :int window: number of most recent frames to keep, None to keep all of them
+        :int capacity: initial number of frames allocated when window is None
+        """
+        self.window = window
+        self.capacity = window if window else capacity
+        self.buffer = None
+        self.total = 0
+
+    def _allocate(self, frame):
+        size = 2 * self.window if self.window else self.capacity
+        self.buffer = np.empty((size,) + frame.shape, dtype=frame.dtype)
+
+    def append(self, frame):
+        frame = np.asarray(frame)
+        if self.buffer is None:
+            self._allocate(frame)
+        if self.window:
+            position = self.total % self.window
+            self.buffer[position] = frame
+            self.buffer[position + self.window] = frame
+        else:
+            if self.total == self.buffer.shape[0]:
+                buffer = np.empty((2 * self.total,) + self.buffer.shape[1:], dtype=self.buffer.dtype)
+                buffer[:self.total] = self.buffer
+                self.buffer = buffer
+            self.buffer[self.total] = frame
+        self.total += 1
+
+    def view(self):
+        """
+        :return: np.array(len, ...) read-only view of the stored frames in time order
+        """
+        if self.buffer is None:
+            return np.empty((0,))
+        if self.window:
+            length = min(self.total, self.window)
+            end = (self.total - 1) % self.window + 1 + self.window
+            view = self.buffer[end - length:end]
+        else:
+            view = self.buffer[:self.total]
+        view = view.view()
+        view.flags.writeable = False
+        return view
+
+    def __len__(self):
+        return min(self.total, self.window) if self.window else self.total
+
+    def __getitem__(self, item):
+        return self.view()[item]
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __array__(self, dtype=None, copy=None):
+        view = self.view()
+        if dtype is not None and view.dtype != dtype:
+            return view.astype(dtype)
+        if copy:
+            return view.copy()
+        return view
@@ -1,4 +1,6 @@
 import numpy as np
+from history import History
+from utils import log_combine
 
 
 def kl_divergence_estimation_(beliefs, combination_matrix, step_size, window):
@@ -17,18 +19,109 @@ def kl_divergence_estimation_(beliefs, combination_matrix, step_size, window):
 
 
 def kl_divergence_estimation(beliefs, combination_matrix, step_size, window):
-    states, agents = beliefs[0].shape
-    kl_div = np.zeros((agents, states - 1))
-    log_beliefs = []
-    for time in range(window, 0, -1):
-        log_beliefs.append(np.array([np.log(
-            beliefs[-time-1][0, :] / \
-            beliefs[-time-1][n, :]) for n in range(1, states)
-        ]).T)
-    for log_prev, log in zip(log_beliefs[:-1], log_beliefs[1:]):
-        kl_div += log - (1-step_size) * combination_matrix.T @ log_prev
-    kl_div /= step_size * window
-    return kl_div
+    """
+    :beliefs: sequence of states x agents intermediate beliefs, the `window` entries before the last one are used
+    :return: np.array(agents, states - 1)
+    """
+    log_belief = np.log(np.asarray(beliefs[-window - 1:-1]))
+    return kl_divergence_from_log_ratios(log_belief[:, :1] - log_belief[:, 1:], combination_matrix, step_size)
+
+
+def kl_divergence_from_log_ratios(log_ratios, combination_matrix, step_size):
+    """
+    kl_divergence_estimation on log-belief ratios, e.g. network.log_ratio_history[-window - 1:-1], without any log.
+    The estimate is linear in the log-ratios, so they are summed over the window first and the combination
+    matrix is applied once.
+    :np.array log_ratios: (window, states - 1, agents) consecutive log(belief[0] / belief[n]), n = 1..states-1
+    :return: np.array(agents, states - 1)
+    """
+    log_ratios = np.asarray(log_ratios, dtype=float)
+    multiplier_1 = 1. if step_size is None else 1. - step_size
+    multiplier_2 = 1. if step_size is None else step_size
+    kl_div = log_ratios[1:].sum(0) - multiplier_1 * log_combine(log_ratios[:-1].sum(0), combination_matrix)
+    return (kl_div / (multiplier_2 * log_ratios.shape[0])).T
+
+
+def log_belief_ratios(belief):
+    """
+    :np.array belief: (..., states, agents)
+    :return: np.array(..., agents, states - 1) of log(belief[0] / belief[n]), n = 1..states-1
+    """
+    log_belief = np.log(belief)
+    return np.swapaxes(log_belief[..., :1, :] - log_belief[..., 1:, :], -1, -2)
+
+
+class OnlineKLEstimator():
+    def __init__(self, combination_matrix, step_size, window, resync=None):
+        """
+        Sliding-window version of kl_divergence_estimation. It keeps the last `window` log-belief ratios in a
+        ring buffer together with their running sum, so each update adds the newest term and drops the expiring
+        one in O(agents x states). The window sum does not depend on the combination matrix (it is applied
+        when the estimate is read), so the matrix may be replaced between updates at no extra cost.
+        Attached to a Network (network.attach(estimator)) it is fed every new intermediate belief, and
+        estimate() equals kl_divergence_estimation(network.intermediate_belief_history, combination_matrix,
+        step_size, window) once the window is full.
+
+        :combination_matrix: agents x agents np.array or scipy.sparse matrix
+        :float step_size: delta, None for traditional social learning
+        :int window: window length
+        :int resync: recompute the running sum from the ring every `resync` updates to drop rounding drift,
+            defaults to the window length
+        """
+        self.combination_matrix = combination_matrix
+        self.step_size = step_size
+        self.window = window
+        self.resync = window if resync is None else resync
+        self.log_beliefs = History(window)
+        self.total = None
+        self.latest = None
+        self.updates = 0
+
+    def set_combination_matrix(self, combination_matrix):
+        self.combination_matrix = combination_matrix
+
+    def update(self, belief):
+        """
+        :np.array belief: states x agents intermediate belief of the newest step
+        """
+        self._push(log_belief_ratios(belief))
+
+    def update_log_ratio(self, log_ratio):
+        """
+        :np.array log_ratio: states - 1 x agents log-belief ratios of the newest step (Network.log_ratio)
+        """
+        self._push(np.swapaxes(log_ratio, -1, -2).copy())
+
+    def _push(self, log_ratio):
+        # the newest belief only enters the window at the next update, as in kl_divergence_estimation
+        if self.latest is not None:
+            if len(self.log_beliefs) == self.window:
+                self.total -= self.log_beliefs[0]
+            self.log_beliefs.append(self.latest)
+            if self.total is None:
+                self.total = np.zeros_like(self.latest)
+            self.total += self.latest
+            self.updates += 1
+            if self.updates % self.resync == 0:
+                self.recompute()
+        self.latest = log_ratio
+
+    def recompute(self):
+        self.total = self.log_beliefs.view().sum(0)
+
+    def estimate(self):
+        """
+        :return: np.array(agents, states - 1) estimated KL divergences, None before the first term
+        """
+        length = len(self.log_beliefs)
+        if length < 2:
+            return None
+        multiplier_1 = 1. if self.step_size is None else 1. - self.step_size
+        multiplier_2 = 1. if self.step_size is None else self.step_size
+        log_cur = self.total - self.log_beliefs[0]
+        log_prev = self.total - self.log_beliefs[-1]
+        kl_div = log_cur - multiplier_1 * (self.combination_matrix.T @ log_prev)
+        return kl_div / (multiplier_2 * length)
 
 
 def optimization_step(log_cur, log_prev, adj_matrix_prev, kl_div, lr=0.05, alpha=0.,
@@ -70,4 +163,89 @@ def get_loss(combination_matrix, log_prev, log_cur, kl_div, step_size=None, mult
         log_cur = log_cur.reshape([-1, 1])
         log_prev = log_prev.reshape([-1, 1])
         kl_div = kl_div.reshape([-1, 1])
-    return .5*np.linalg.norm(log_cur - multiplier_1*combination_matrix.T@log_prev - multiplier_2*kl_div, ord=2)**2
\ No newline at end of file
+    return .5*np.linalg.norm(log_cur - multiplier_1*combination_matrix.T@log_prev - multiplier_2*kl_div, ord=2)**2
+
+
+def project_columns_simplex(matrix):
+    """
+    Exact Euclidean projection of every column onto the probability simplex (sort-based).
+    :np.array matrix: (..., agents, agents)
+    :return: np.array(..., agents, agents) non-negative with columns summing to 1
+    """
+    n = matrix.shape[-2]
+    ordered = -np.sort(-matrix, axis=-2)
+    cumsum = np.cumsum(ordered, axis=-2) - 1.
+    index = np.arange(1, n + 1).reshape(-1, 1)
+    rho = (ordered - cumsum / index > 0).sum(-2, keepdims=True)
+    theta = np.take_along_axis(cumsum, rho - 1, axis=-2) / rho
+    return np.maximum(matrix - theta, 0.)
+
+
+def learn_combination_matrix(log_beliefs, kl_div, adj_matrix_init, lr=0.05, alpha=0., step_size=None,
+                             iterations=1000, tol=1e-10, projection=True):
+    """
+    Full-batch version of iterating optimization_step over a window of log-beliefs, for several learning rates
+    and alphas at once. The window enters only through its Gram matrices, so an iteration costs
+    O(configs x agents^3) whatever the window length. Columns are projected exactly onto the simplex, the
+    L1 term uses the subgradient sign(C), and every configuration stops once its mean loss changes by less
+    than tol (relative).
+
+    :np.array log_beliefs: (time, agents) or (time, agents, states - 1) consecutive log-beliefs
+    :np.array kl_div: (agents,) or (agents, states - 1)
+    :np.array adj_matrix_init: agents x agents initial combination matrix
+    :lr: float or np.array(configs) learning rates
+    :alpha: float or np.array(configs) L1 weights, broadcast against lr
+    :return: np.array(configs, agents, agents) learned matrices (agents x agents if lr and alpha are scalars),
+        np.array(iterations, configs) mean loss per pair, nan once a configuration has converged
+    """
+    if step_size is None:
+        multiplier_1 = 1.
+        multiplier_2 = 1.
+    else:
+        multiplier_1 = 1. - step_size
+        multiplier_2 = step_size
+    log_beliefs = np.asarray(log_beliefs, dtype=float)
+    if log_beliefs.ndim == 2:
+        log_beliefs = log_beliefs[:, :, None]
+    kl_div = np.asarray(kl_div, dtype=float).reshape(log_beliefs.shape[1], -1)
+    scalar = np.ndim(lr) == 0 and np.ndim(alpha) == 0
+    lr, alpha = np.broadcast_arrays(np.atleast_1d(lr).astype(float), np.atleast_1d(alpha).astype(float))
+    lr, alpha = lr[:, None, None], alpha[:, None, None]
+
+    # window statistics, sum_t of log_cur log_prev.T, log_prev log_prev.T, ...
+    log_cur, log_prev = log_beliefs[1:], log_beliefs[:-1]
+    pairs = log_cur.shape[0]
+    cross = np.einsum('tis,tjs->ij', log_cur, log_prev)
+    gram = np.einsum('tis,tjs->ij', log_prev, log_prev)
+    kl_cross = kl_div @ log_prev.sum(0).T
+    target = (cross - multiplier_2 * kl_cross).T
+    const = (log_cur**2).sum() - 2 * multiplier_2 * (log_cur.sum(0) * kl_div).sum() + \
+        multiplier_2**2 * pairs * (kl_div**2).sum()
+
+    def loss(combination_matrix, gram_comb):
+        res = const - 2 * multiplier_1 * (combination_matrix * target).sum((-2, -1)) + \
+            multiplier_1**2 * (combination_matrix * gram_comb).sum((-2, -1))
+        return .5 * res / pairs
+
+    combination_matrix = np.repeat(np.asarray(adj_matrix_init, dtype=float)[None], lr.shape[0], 0)
+    active = np.ones(lr.shape[0], dtype=bool)
+    gram_comb = gram @ combination_matrix
+    loss_prev = loss(combination_matrix, gram_comb)
+    losses = []
+    for _ in range(iterations):
+        update = combination_matrix + lr * (
+            multiplier_1 * (target - multiplier_1 * gram_comb) / pairs - alpha * np.sign(combination_matrix)
+        )
+        if projection:
+            update = project_columns_simplex(update)
+        combination_matrix[active] = update[active]
+        gram_comb = gram @ combination_matrix
+        loss_cur = loss(combination_matrix, gram_comb)
+        losses.append(np.where(active, loss_cur, np.nan))
+        active &= np.abs(loss_prev - loss_cur) > tol * np.maximum(np.abs(loss_cur), 1.)
+        loss_prev = loss_cur
+        if not active.any():
+            break
+    if scalar:
+        combination_matrix = combination_matrix[0]
+    return combination_matrix, np.array(losses)
@@ -0,0 +1,233 @@
+import multiprocessing
+import threading
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+from social_learning import Network, _log_intermediate, _log_likelihood_values, _log_normalize
+from utils import log_combine
+
+_SHARED = ('belief', 'intermediate_belief', 'log_belief', 'log_intermediate_belief')
+
+
+def partition_blocks(combination_matrix, workers, labels=None):
+    """
+    Splits the agents into `workers` blocks of similar cost (column nonzeros of the combination matrix plus one
+    per agent), keeping communities together: whole communities are packed greedily, largest first, and only
+    communities bigger than a block are cut.
+    :combination_matrix: agents x agents np.array or scipy.sparse matrix
+    :int workers: number of blocks
+    :np.array labels: community of every agent, None to cut the reverse Cuthill-McKee ordering of the graph
+        (which keeps densely connected agents next to each other) into contiguous communities
+    :return: list of sorted np.array agent indices, one per block
+    """
+    agents = combination_matrix.shape[0]
+    matrix = sparse.csc_matrix(combination_matrix)
+    cost = np.diff(matrix.indptr) + 1.
+    if labels is None:
+        pattern = ((matrix + matrix.T) != 0).astype(np.int8).tocsr()
+        order = reverse_cuthill_mckee(pattern, symmetric_mode=True)
+        labels = np.empty(agents, dtype=np.int64)
+        labels[order] = np.minimum((np.cumsum(cost[order]) - cost[order]) * workers // cost.sum(), workers - 1)
+    labels = np.asarray(labels)
+    target = cost.sum() / workers
+
+    pieces = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        # cut communities larger than a block into contiguous pieces
+        cuts = int(np.ceil(cost[members].sum() / target - 1e-9))
+        if cuts > 1:
+            bounds = (np.cumsum(cost[members]) - cost[members]) * cuts // cost[members].sum()
+            pieces.extend(members[bounds == piece] for piece in range(cuts))
+        else:
+            pieces.append(members)
+    pieces.sort(key=lambda members: -cost[members].sum())
+
+    blocks = [[] for _ in range(workers)]
+    load = np.zeros(workers)
+    for members in pieces:
+        worker = int(np.argmin(load))
+        blocks[worker].append(members)
+        load[worker] += cost[members].sum()
+    return [np.sort(np.concatenate(block)) if block else np.zeros(0, dtype=np.int64) for block in blocks]
+
+
+def _attach(specs):
+    segments, arrays = [], {}
+    for name, (segment_name, shape, dtype) in specs.items():
+        segment = shared_memory.SharedMemory(name=segment_name)
+        segments.append(segment)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+    return segments, arrays
+
+
+def _worker(specs, block, combination, likelihood, log_likelihood, strategy, step_size, beta, barrier):
+    segments, arrays = _attach(specs)
+    try:
+        while True:
+            barrier.wait()
+            if arrays['command'][0]:
+                break
+            # combination step, only the agents of the block
+            sample = arrays['observation'][..., block]
+            values = _log_likelihood_values(likelihood, sample, strategy, log_likelihood)
+            log_intermediate = _log_intermediate(values, arrays['log_belief'][..., block], step_size, beta)
+            arrays['log_intermediate_belief'][..., block], arrays['intermediate_belief'][..., block] = \
+                _log_normalize(log_intermediate)
+            barrier.wait()
+
+            # adaptation step, reads the intermediate beliefs of the in-neighbours from the other blocks
+            arrays['log_belief'][..., block], arrays['belief'][..., block] = \
+                _log_normalize(log_combine(arrays['log_intermediate_belief'], combination))
+            barrier.wait()
+    except BaseException:
+        barrier.abort()
+        raise
+    finally:
+        del arrays
+        for segment in segments:
+            segment.close()
+
+
+def _release(processes, segments, barrier, command):
+    if processes:
+        command[0] = 1
+        try:
+            barrier.wait(timeout=10)
+        except Exception:
+            pass
+        for process in processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        processes.clear()
+    for segment in segments:
+        segment.close()
+        segment.unlink()
+    segments.clear()
+
+
+class ParallelNetwork(Network):
+    def __init__(self, agents, states, state_true, adjacency_matrix, combination_weights, likelihood, generator,
+                 belief_init, step_size=None, window=None, beta=None, writer=None, block=None, history=True,
+                 profile=False, log_ratios=False, workers=2, clusters_agents=None, partition=None):
+        """
+        Network stepped by `workers` processes, each owning a block of agents (see partition_blocks).
+        Beliefs live in multiprocessing.shared_memory arrays; the main process draws the observations, and
+        every worker runs the combination step of its block, waits on a barrier, then the adaptation step of
+        its block with its columns of C (in-neighbours only, so other blocks are read at the boundary only),
+        and waits again. Everything else (histories, observers, checkpoints) is the Network one.
+        With a sparse C the trajectory is bit-identical to Network's; a dense C is split by columns, which
+        can change the BLAS summation order at rounding level. Workers start on the first step; call close()
+        (or use the network as a context manager) to stop them and free the shared memory.
+
+        :int workers: number of processes
+        :list clusters_agents: cluster sizes of a consecutive layout (as create_network(7)), used as communities
+        :np.array partition: community of every agent, overrides clusters_agents; both None to compute one
+        """
+        super().__init__(agents, states, state_true, adjacency_matrix, combination_weights, likelihood, generator,
+                         belief_init, step_size=step_size, window=window, beta=beta, writer=writer, block=block,
+                         history=history, profile=profile, log_ratios=log_ratios)
+        self.workers = workers
+        if partition is None and clusters_agents is not None:
+            partition = np.repeat(np.arange(len(clusters_agents)), clusters_agents)
+        self.partition = partition
+        self.blocks = None
+        self._processes = []
+        self._segments = []
+        self._shared = {}
+        self._specs = {}
+        self._barrier = multiprocessing.Barrier(workers + 1)
+        self._allocate()
+        self._finalizer = weakref.finalize(self, _release, self._processes, self._segments, self._barrier,
+                                           self._shared['command'])
+
+    def _allocate(self):
+        sample_dtype = np.float64 if self.generator.strategy == 2 else np.int64
+        frames = {name: (self.belief.shape, self.dtype) for name in _SHARED}
+        frames['observation'] = (self.belief.shape[:-2] + (self.agents,), np.dtype(sample_dtype))
+        frames['command'] = ((1,), np.dtype(np.int64))
+        for name, (shape, dtype) in frames.items():
+            size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+            segment = shared_memory.SharedMemory(create=True, size=size)
+            self._segments.append(segment)
+            self._shared[name] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+            self._specs[name] = (segment.name, shape, dtype)
+        self._shared['command'][0] = 0
+        self._share()
+
+    def _share(self):
+        """
+        Moves the current state into the shared arrays, which then back the Network attributes.
+        """
+        for name in _SHARED:
+            self._shared[name][...] = getattr(self, name)
+            setattr(self, name, self._shared[name])
+
+    def _start(self):
+        self.blocks = partition_blocks(self.C, self.workers, self.partition)
+        combination = sparse.csc_matrix(self.C) if sparse.issparse(self.C) else np.asarray(self.C)
+        strategy = self.generator.strategy
+        log_likelihood = self._log_likelihood_table_default()
+        context = multiprocessing.get_context()
+        for block in self.blocks:
+            args = (self._specs, block, combination[:, block], self.likelihood[block],
+                    None if log_likelihood is None else log_likelihood[block], strategy, self.step_size, self.beta,
+                    self._barrier)
+            process = context.Process(target=_worker, args=args, daemon=True)
+            process.start()
+            self._processes.append(process)
+
+    def _advance(self, sample):
+        if not self._processes:
+            self._start()
+        self._shared['observation'][...] = sample
+        try:
+            self._barrier.wait()
+            self._barrier.wait()
+            self._tick('combination')
+            self._barrier.wait()
+            self._tick('adaptation')
+        except threading.BrokenBarrierError:
+            self.close()
+            raise RuntimeError("A worker process failed.")
+
+    def set_combination_matrix(self, combination_matrix, adjacency_matrix=None):
+        """
+        As Network.set_combination_matrix; the workers are restarted with the new blocks of C at the next step.
+        """
+        super().set_combination_matrix(combination_matrix, adjacency_matrix)
+        self._stop()
+
+    def load(self, path, restore_rng=True):
+        super().load(path, restore_rng)
+        self._share()
+
+    def _stop(self):
+        if self._processes:
+            _release(self._processes, [], self._barrier, self._shared['command'])
+            # the finalizer holds this barrier, so it is reused by the next workers rather than replaced
+            self._barrier.reset()
+            self._shared['command'][0] = 0
+
+    def close(self):
+        """
+        Stops the workers and frees the shared memory; the current state is copied back to private arrays.
+        """
+        if not self._segments:
+            return
+        self._stop()
+        for name in _SHARED:
+            setattr(self, name, np.array(self._shared[name]))
+        self._shared = {}
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,132 +1,639 @@
+import hashlib
+import json
+import time
+
 import numpy as np
-from utils import kl_divergence
+from scipy import sparse
+from utils import kl_divergence, kl_divergence_tensor, log_combine
 from scipy.stats import norm
+from history import History
+from optimization import log_belief_ratios
+
+
+def _likelihood_values(likelihood, sample, strategy):
+    """
+    :np.array likelihood: agents x states x params
+    :np.array sample: (..., agents) observations
+    :int strategy: 0/1 for multinomial, 2 for gaussian
+    :return: np.array(..., states, agents) likelihood of the observations under every state
+    """
+    agents = likelihood.shape[0]
+    if (strategy == 0) or (strategy == 1):
+        lh = likelihood[np.arange(agents), :, sample]  # ... x agents x states
+        lh = np.swapaxes(lh, -1, -2)
+    elif strategy == 2:
+        mu = likelihood[:, :, 0].T
+        sigma = likelihood[:, :, 1].T
+        lh = norm.pdf((sample[..., None, :] - mu) / sigma)
+        lh = np.maximum(lh, 1e-3)
+    else:
+        raise ValueError("Invalid selection of the strategy.")
+    return lh
+
+
+def _log_likelihood_values(likelihood, sample, strategy, log_likelihood=None):
+    """
+    log of _likelihood_values, multinomial values are read from log_likelihood = np.log(likelihood) if given
+    :return: np.array(..., states, agents)
+    """
+    if (strategy == 0) or (strategy == 1):
+        if log_likelihood is None:
+            log_likelihood = np.log(likelihood)
+        return _likelihood_values(log_likelihood, sample, strategy)
+    elif strategy == 2:
+        mu = likelihood[:, :, 0].T
+        sigma = likelihood[:, :, 1].T
+        return np.maximum(norm.logpdf((sample[..., None, :] - mu) / sigma), np.log(1e-3))
+    raise ValueError("Invalid selection of the strategy.")
+
+
+def _log_intermediate(log_likelihood, log_belief, step_size, beta):
+    """
+    Unnormalised log intermediate belief, beta log L + (1 - step_size) log belief (log L + log belief without
+    step size).
+    """
+    if step_size:
+        return beta * log_likelihood + (1 - step_size) * log_belief
+    return log_likelihood + log_belief
+
+
+def _log_normalize(log_belief):
+    """
+    Log-sum-exp normalisation over the states axis (-2).
+    :return: normalised log-belief, belief
+    """
+    log_belief = log_belief - log_belief.max(-2, keepdims=True)
+    belief = np.exp(log_belief)
+    total = belief.sum(-2, keepdims=True)
+    belief /= total
+    log_belief -= np.log(total)
+    return log_belief, belief
+
+
+def _content_key(array):
+    array = np.ascontiguousarray(array)
+    return array.shape, array.dtype.str, hashlib.sha1(array).hexdigest()
+
+
+def _geometric_sum(ratio, n):
+    """
+    :np.array ratio: (complex) ratios z
+    :n: number of terms, np.inf for the infinite series
+    :return: np.array sum_{i<n} z^i
+    """
+    ratio = np.asarray(ratio, dtype=complex)
+    if np.isinf(n):
+        if np.any(np.abs(ratio) >= 1):
+            raise ValueError("The steady state requires a step size (spectral radius < 1).")
+        return 1 / (1 - ratio)
+    ones = np.abs(1 - ratio) < 1e-12
+    ratio_ = np.where(ones, 0, ratio)
+    res = -np.expm1(n * np.log(np.where(ratio_ == 0, 1, ratio_))) / (1 - ratio_)
+    res = np.where(ratio_ == 0, 1. if n > 0 else 0., res)
+    return np.where(ones, n, res)
+
 
 class Network():
+    runs = None
+    _history_names = ('belief_history', 'intermediate_belief_history', 'observation_history', 'log_ratio_history')
+
     def __init__(self, agents, states, state_true, adjacency_matrix, combination_weights, likelihood, generator,
-                 belief_init, step_size=None, window=None, beta=None):
+                 belief_init, step_size=None, window=None, beta=None, writer=None, block=None, history=True,
+                 profile=False, inplace=False, dtype=None, log_ratios=False):
         self.agents = agents
         self.states = states
         self.state_true = state_true
         self.A = adjacency_matrix
-        self.C = combination_weights
+        self.C = combination_weights # agents x agents, np.array or scipy.sparse matrix
         self.likelihood = likelihood # agents x states x params
         self.generator = generator
         self.step_size = step_size
         self.window = window
-        self._init_history(belief_init)
+        self.writer = writer # optional trajectory.TrajectoryWriter receiving every belief
+        self.block = block # observations drawn per generator.sample_block call, None to sample every step
+        self._samples = None
+        self._samples_index = 0
+        self._samples_version = None
+        self.history = history # False to keep only the current state, no belief or observation histories
+        self.inplace = inplace or dtype is not None # log-domain step writing into preallocated buffers
+        # np.float32 halves memory traffic (in-place only); C is then cast once, replace it with set_combination_matrix
+        self.dtype = np.dtype(float if dtype is None else dtype)
+        self.belief = np.array(belief_init, dtype=self.dtype)
+        self.intermediate_belief = np.zeros_like(self.belief)
+        # beliefs are carried as normalised log-beliefs, the probabilities are their exp
+        with np.errstate(divide='ignore'):
+            self.log_belief = np.log(self.belief)
+        self.log_intermediate_belief = np.full_like(self.belief, -np.inf)
+        self._log_ratio = None
+        self._log_ratio_updates = None
+        self._log_likelihood_source = None
+        self.observation = None
+        self.steps = 0
+        self._updates = 0 # steps taken since construction, unlike steps never reset (keys the log_ratio cache)
+        self.log_ratios = log_ratios # also keep log_ratio_history (requires history)
+        if self.history:
+            self._init_history(self.belief)
+        else:
+            self.belief_history = self.intermediate_belief_history = self.observation_history = None
+            self.log_ratio_history = None
+        self.observers = []
+        self.profile = profile # accumulate per-phase wall time in self.timers
+        self.timers = dict.fromkeys(('sampling', 'combination', 'adaptation', 'history', 'observers'), 0.)
+        self._tick_time = None
+        self._spectrum_cache = {}
+        self._kl_cache = {}
+        if self.writer is not None:
+            self.writer.append(self.belief)
         self.beta = beta
         if self.beta is None:
             self.beta = self.step_size
+        self._combination_source = None
+        if self.inplace:
+            self._init_buffers()
 
         '''
         strategy: 0/1 for multinomial, 2 for gaussian
         '''
             
     def _init_history(self, belief_init):
-        self.belief_history = [belief_init]
-        self.intermediate_belief_history = [np.zeros((self.states, self.agents))]
-        self.observation_history = [None]
+        """
+        Histories are History ring buffers holding the last `window` entries (all of them if window is None).
+        observation_history only holds actual observations, so it is one entry shorter than the belief histories
+        until the window is full; so does log_ratio_history (log_ratio of every step), kept if log_ratios is set.
+        """
+        self.belief_history = History(self.window)
+        self.belief_history.append(belief_init)
+        self.intermediate_belief_history = History(self.window)
+        self.intermediate_belief_history.append(np.zeros_like(belief_init))
+        self.observation_history = History(self.window)
+        self.log_ratio_history = History(self.window) if self.log_ratios else None
+
+    def _init_buffers(self):
+        """
+        Work buffers of the in-place step, all (..., states, agents) in self.dtype.
+        log_belief and log_intermediate_belief are updated in place as well.
+        """
+        shape = self.belief.shape
+        self._work = np.empty(shape, self.dtype)
+        self._reduced = np.empty(shape[:-2] + (1, shape[-1]), self.dtype)
+        self._exponent = self.beta if self.step_size else 1
+        self._decay = 1 - self.step_size if self.step_size else 1
+        self._table_index = np.empty(shape, dtype=np.intp)
+        self._likelihood_tables()
+
+    def _likelihood_tables(self):
+        """
+        Likelihood tables of the in-place step with the exponent beta folded in: a flat log-likelihood table read
+        with np.take for multinomial observations, per-state means and inverse deviations for gaussian ones.
+        Rebuilt by _log_likelihood when self.likelihood is replaced.
+        """
+        self._likelihood_source = self.likelihood
+        likelihood = np.asarray(self.likelihood, dtype=float)
+        agents, states, params = likelihood.shape
+        if (self.generator.strategy == 0) or (self.generator.strategy == 1):
+            with np.errstate(divide='ignore'):
+                table = self._exponent * np.log(likelihood)
+            self._log_likelihood_table = table.astype(self.dtype).ravel()
+            self._table_offset = np.arange(agents) * states * params + np.arange(states)[:, None] * params
+        elif self.generator.strategy == 2:
+            self._mu = likelihood[:, :, 0].T.astype(self.dtype)
+            self._sigma_inv = (1 / likelihood[:, :, 1].T).astype(self.dtype)
+        else:
+            raise ValueError("Invalid selection of the strategy.")
+
+    def _combination_matrix(self):
+        """
+        self.C cast to self.dtype, redone only when self.C is replaced. If self.C already has that dtype it is
+        used as is, so in-place edits of it are seen; a cast copy (e.g. float64 C with dtype=np.float32) is not
+        rebuilt on in-place edits, change C through set_combination_matrix instead.
+        """
+        if self._combination_source is not self.C:
+            self._combination_source = self.C
+            self._combination = self.C.astype(self.dtype, copy=False)
+        return self._combination
+
+    def _log_likelihood(self, sample, out):
+        """
+        exponent * log likelihood of the observations under every state, written to out (..., states, agents).
+        """
+        if self._likelihood_source is not self.likelihood:
+            self._likelihood_tables()
+        if (self.generator.strategy == 0) or (self.generator.strategy == 1):
+            np.add(self._table_offset, sample[..., None, :], out=self._table_index)
+            np.take(self._log_likelihood_table, self._table_index, out=out, mode='clip')
+        else:
+            # log max(norm.pdf(z), 1e-3) with z = (x - mu) / sigma
+            np.subtract(sample[..., None, :], self._mu, out=out)
+            out *= self._sigma_inv
+            np.square(out, out=out)
+            out *= -.5
+            out -= .5 * np.log(2 * np.pi)
+            np.maximum(out, np.log(1e-3), out=out)
+            if self._exponent != 1:
+                out *= self._exponent
+        return out
+
+    def _normalize(self, log_belief, belief):
+        """
+        belief = softmax of log_belief over the states, and log_belief shifted to log(belief), both in place.
+        """
+        reduced = self._reduced
+        np.max(log_belief, axis=-2, keepdims=True, out=reduced)
+        log_belief -= reduced
+        np.exp(log_belief, out=belief)
+        np.sum(belief, axis=-2, keepdims=True, out=reduced)
+        belief /= reduced
+        np.log(reduced, out=reduced)
+        log_belief -= reduced
+
+    def _step_inplace(self, sample):
+        # combination step (intermediate beliefs)
+        log_intermediate = self._log_likelihood(sample, self.log_intermediate_belief)
+        if self._decay != 1:
+            np.multiply(self.log_belief, self._decay, out=self._work)
+            log_intermediate += self._work
+        else:
+            log_intermediate += self.log_belief
+        self._normalize(log_intermediate, self.intermediate_belief)
+        self._tick('combination')
+
+        # adaptation step
+        log_combine(log_intermediate, self._combination_matrix(), out=self.log_belief)
+        self._normalize(self.log_belief, self.belief)
+        self._tick('adaptation')
+
+    def _log_likelihood_table_default(self):
+        """
+        np.log(self.likelihood) for multinomial observations, redone only when self.likelihood is replaced.
+        """
+        if self.generator.strategy == 2:
+            return None
+        if self._log_likelihood_source is not self.likelihood:
+            self._log_likelihood_source = self.likelihood
+            with np.errstate(divide='ignore'):
+                self._log_likelihood_default = np.log(self.likelihood)
+        return self._log_likelihood_default
+
+    @property
+    def log_ratio(self):
+        """
+        Read-only (..., states - 1, agents) log(intermediate_belief[0] / intermediate_belief[n]), n = 1..states-1,
+        taken from the log-beliefs once per step into a reused buffer. The result is a view of that buffer: the
+        next step overwrites it in place, so copy it to keep it (get_log_beliefs returns a copy).
+        Its transpose is a zero-copy view in the agents x states - 1 layout of the optimization module.
+        """
+        if self._log_ratio_updates != self._updates:
+            log = self.log_intermediate_belief
+            if self._log_ratio is None:
+                self._log_ratio_buffer = np.empty(log.shape[:-2] + (self.states - 1, self.agents), log.dtype)
+                self._log_ratio = self._log_ratio_buffer.view()
+                self._log_ratio.flags.writeable = False
+            with np.errstate(invalid='ignore'):
+                np.subtract(log[..., :1, :], log[..., 1:, :], out=self._log_ratio_buffer)
+            self._log_ratio_updates = self._updates
+        return self._log_ratio
+
+    def _sample(self):
+        if not self.block:
+            return self.generator.sample(self.runs)
+        if self._samples is None or self._samples_index == len(self._samples) or \
+                self._samples_version != self.generator.version:
+            self._samples = self.generator.sample_block(self.block, self.runs)
+            self._samples_index = 0
+            self._samples_version = self.generator.version
+        sample = self._samples[self._samples_index]
+        self._samples_index += 1
+        return sample
+
+    def _tick(self, phase=None):
+        if self.profile:
+            now = time.perf_counter()
+            if phase is not None:
+                self.timers[phase] += now - self._tick_time
+            self._tick_time = now
 
     def step(self):
-        sample = self.generator.sample()
-        self.observation_history.append(np.copy(sample))
+        self._tick()
+        sample = self._sample()
+        self._tick('sampling')
+        self._advance(sample)
+
+        self.observation = sample
+        self.steps += 1
+        self._updates += 1
+        if self.history:
+            self.observation_history.append(sample)
+            self.intermediate_belief_history.append(self.intermediate_belief)
+            self.belief_history.append(self.belief)
+            if self.log_ratio_history is not None:
+                self.log_ratio_history.append(self.log_ratio)
+        if self.writer is not None:
+            self.writer.append(self.belief)
+        self._tick('history')
 
+        if self.observers:
+            self._notify()
+        self._tick('observers')
+
+    def _advance(self, sample):
+        """
+        Combination and adaptation steps, updating belief, intermediate_belief and their logs.
+        """
+        if self.inplace:
+            self._step_inplace(sample)
+            return
         # combination step (intermediate beliefs)
-        denominator = np.zeros(self.agents)
-        intermediate_belief = np.zeros((self.states, self.agents))
-        for state in range(self.states):
-            if (self.generator.strategy == 0) or (self.generator.strategy == 1):
-                likelihood = self.likelihood[:, state, :][np.arange(self.agents), sample]
-                if self.step_size:
-                    intermediate_belief[state] = np.power(likelihood, self.beta) *\
-                                                 np.power(self.belief_history[-1][state], 1 - self.step_size)
-                else:
-                    intermediate_belief[state] = likelihood * self.belief_history[-1][state]
-            elif self.generator.strategy == 2:
-                lh_state = self.likelihood[:, state, :][np.arange(self.agents), :]
-                for agent in range(self.agents):
-                    mu, sigma = lh_state[agent]
-                    lh = norm.pdf((sample[agent] - mu) / sigma)
-                    if lh < 1e-3:
-                        lh = 1e-3
-                    intermediate_belief[state, agent] = np.power(lh, self.beta) *\
-                                                        np.power(self.belief_history[-1][state, agent], 1 - self.step_size)
-            denominator += intermediate_belief[state]
-        intermediate_belief /= denominator[None, :]
-        self.intermediate_belief_history.append(intermediate_belief)
+        log_likelihood = _log_likelihood_values(self.likelihood, sample, self.generator.strategy,
+                                                self._log_likelihood_table_default())
+        log_intermediate = _log_intermediate(log_likelihood, self.log_belief, self.step_size, self.beta)
+        self.log_intermediate_belief, self.intermediate_belief = _log_normalize(log_intermediate)
+        self._tick('combination')
 
         # adaptation step
-        denominator = np.zeros(self.agents)
-        belief = np.zeros((self.states, self.agents))
-        for state in range(self.states):
-            belief[state] = np.exp(self.C.T @ np.log(self.intermediate_belief_history[-1][state, :]))
-            denominator += belief[state]
-        belief /= denominator[None, :]
-        self.belief_history.append(belief)
-
-        if self.window:
-            self.observation_history = self.observation_history[-self.window:]
-            self.intermediate_belief_history = self.intermediate_belief_history[-self.window:]
-            self.belief_history = self.belief_history[-self.window:]
+        self.log_belief, self.belief = _log_normalize(log_combine(self.log_intermediate_belief, self.C))
+        self._tick('adaptation')
+
+    def _notify(self):
+        views = []
+        for array in (self.belief, self.intermediate_belief, self.observation):
+            view = array.view()
+            view.flags.writeable = False
+            views.append(view)
+        for callback, every in self.observers:
+            if self.steps % every == 0:
+                callback(self.steps, *views)
+
+    def add_observer(self, callback, every=1):
+        """
+        Calls callback(steps, belief, intermediate_belief, observation) every `every` steps with read-only views of
+        the current state, e.g. to compute metrics on the fly with history=False.
+        """
+        self.observers.append((callback, every))
+        return callback
+
+    def attach(self, estimator, every=1):
+        """
+        Feeds the new intermediate belief to estimator.update every `every` steps,
+        e.g. an optimization.OnlineKLEstimator or a utils.WindowedStateEstimator. Estimators with an
+        update_log_ratio method get log_ratio instead, without any log.
+        """
+        if hasattr(estimator, 'update_log_ratio'):
+            self.add_observer(lambda *args: estimator.update_log_ratio(self.log_ratio), every)
+        else:
+            self.add_observer(lambda steps, belief, intermediate_belief, observation:
+                              estimator.update(intermediate_belief), every)
+        return estimator
+
+    def set_combination_matrix(self, combination_matrix, adjacency_matrix=None):
+        """
+        Swaps the combination matrix between steps (e.g. the output of utils.DynamicGraph.flip), keeping the
+        beliefs, histories and observers. Theory curves use the new matrix from then on.
+        With a dtype other than that of C the in-place step works on a cast copy of C, so C has to be changed
+        through this method rather than edited in place.
+        """
+        if combination_matrix.shape != (self.agents, self.agents):
+            raise ValueError("Invalid shape of the combination matrix.")
+        self.C = combination_matrix
+        if adjacency_matrix is not None:
+            self.A = adjacency_matrix
+        self._combination_source = None
+
+    def burn_in(self, times):
+        """
+        Warm start: runs `times` steps without recording anything (no histories, writer or observers), then
+        restarts the histories from the reached belief, as a new Network built from it would, but keeping the
+        generator stream going. steps and the profiling timers restart from 0.
+        """
+        history, writer, observers = self.history, self.writer, self.observers
+        self.history, self.writer, self.observers = False, None, []
+        try:
+            for _ in range(times):
+                self.step()
+        finally:
+            self.history, self.writer, self.observers = history, writer, observers
+        self.steps = 0
+        self.timers = dict.fromkeys(self.timers, 0.)
+        if self.history:
+            self._init_history(self.belief)
+
+    def save(self, path):
+        """
+        Checkpoint to an npz file: current state, the windowed histories, step count, parameters and the exact
+        state of the generator random stream (and of buffered observations), so that load continues the run
+        bit for bit. The likelihood, the graph, observers and the writer are not stored.
+        :str path: file name or open binary file
+        """
+        checkpoint = {
+            'steps': self.steps,
+            'parameters': json.dumps({'agents': self.agents, 'states': self.states, 'runs': self.runs,
+                                      'step_size': self.step_size, 'beta': self.beta, 'window': self.window,
+                                      'strategy': self.generator.strategy}),
+            'state_true': np.asarray(self.generator.state_true),
+            'belief': self.belief,
+            'intermediate_belief': self.intermediate_belief,
+            'log_belief': self.log_belief,
+            'log_intermediate_belief': self.log_intermediate_belief,
+        }
+        if self.observation is not None:
+            checkpoint['observation'] = self.observation
+        if self.history:
+            for name in self._history_names:
+                if getattr(self, name) is not None and len(getattr(self, name)):
+                    checkpoint[name] = getattr(self, name).view()
+        if self._samples is not None:
+            checkpoint['samples'] = self._samples[self._samples_index:]
+        rng = getattr(self.generator, 'rng', None)
+        if isinstance(rng, (list, tuple)):
+            checkpoint['rng_state'] = json.dumps([generator.bit_generator.state for generator in rng])
+        elif isinstance(rng, np.random.Generator):
+            checkpoint['rng_state'] = json.dumps(rng.bit_generator.state)
+        elif hasattr(rng, 'get_state'):
+            name, keys, position, has_gauss, cached_gaussian = rng.get_state(legacy=True)
+            checkpoint.update(rng_name=name, rng_keys=keys, rng_position=position, rng_has_gauss=has_gauss,
+                              rng_cached_gaussian=cached_gaussian)
+        np.savez(path, **checkpoint)
+
+    def load(self, path, restore_rng=True):
+        """
+        Restores a checkpoint written by save into a network built with the same setup.
+        :str path: file name or open binary file
+        :bool restore_rng: False to keep the current generator stream, e.g. to branch independent runs off one
+            shared burn-in
+        """
+        with np.load(path) as data:
+            checkpoint = {key: data[key] for key in data.files}
+        parameters = json.loads(str(checkpoint['parameters']))
+        for name in ('agents', 'states', 'runs', 'step_size', 'beta', 'window'):
+            if parameters[name] != getattr(self, name):
+                raise ValueError("Invalid checkpoint: {} is {}, expected {}.".format(
+                    name, parameters[name], getattr(self, name)))
+
+        state_true = checkpoint['state_true']
+        if not np.array_equal(np.asarray(self.generator.state_true), state_true):
+            self.generator.state_true = state_true if state_true.ndim else int(state_true)
+        self.steps = int(checkpoint['steps'])
+        self.belief = checkpoint['belief'].astype(self.dtype)
+        self.intermediate_belief = checkpoint['intermediate_belief'].astype(self.dtype)
+        self.observation = checkpoint.get('observation')
+        self.log_belief = checkpoint['log_belief'].astype(self.dtype)
+        self.log_intermediate_belief = checkpoint['log_intermediate_belief'].astype(self.dtype)
+        self._log_ratio_updates = None
+        if self.inplace:
+            self._init_buffers()
+        if self.history:
+            for name in self._history_names:
+                if getattr(self, name) is not None:
+                    setattr(self, name, History(self.window))
+                    for frame in checkpoint.get(name, ()):
+                        getattr(self, name).append(frame)
+
+        self._samples = checkpoint.get('samples')
+        self._samples_index = 0
+        self._samples_version = self.generator.version
+        if not restore_rng:
+            self._samples = None
+        elif 'rng_state' in checkpoint:
+            rng_state = json.loads(str(checkpoint['rng_state']))
+            if isinstance(self.generator.rng, (list, tuple)):
+                for generator, state in zip(self.generator.rng, rng_state):
+                    generator.bit_generator.state = state
+            else:
+                self.generator.rng.bit_generator.state = rng_state
+        elif 'rng_keys' in checkpoint:
+            self.generator.rng.set_state((str(checkpoint['rng_name']), checkpoint['rng_keys'],
+                                          int(checkpoint['rng_position']), int(checkpoint['rng_has_gauss']),
+                                          float(checkpoint['rng_cached_gaussian'])))
+
+    def get_profile(self):
+        """
+        :return: dict phase -> mean wall time per step in seconds (requires profile=True)
+        """
+        return {phase: total / max(self.steps, 1) for phase, total in self.timers.items()}
 
     def get_log_beliefs(self, time, state_0=None, state_1=None, multistate=False):
+        """
+        :int time: index into intermediate_belief_history
+        :return: np.array(..., agents, 1) log(belief[state_0] / belief[state_1]), or if multistate the
+            (..., agents, states - 1) log-ratios against state 0 (leading runs axis for a BatchedNetwork), copied
+            from log_ratio (or log_ratio_history) when time refers to a stored step, so the result stays valid
+            after further steps
+        """
+        if multistate:
+            if time == -1 and self.steps > 0:
+                return np.swapaxes(self.log_ratio, -1, -2).copy()
+            if self.log_ratio_history is not None and -len(self.log_ratio_history) <= time < 0:
+                return np.swapaxes(self.log_ratio_history[time], -1, -2).copy()
+            return log_belief_ratios(self.intermediate_belief_history[time])
+        intermediate_belief = self.intermediate_belief_history[time]
+        log = np.log(intermediate_belief[..., state_0, :] / intermediate_belief[..., state_1, :])
+        return log[..., None]
+
+    def _spectrum(self, combination_matrix):
+        """
+        Eigendecomposition C = V diag(e) V^-1, cached per combination matrix content.
+        (1 - step_size) C shares the eigenvectors, so one entry serves every step size. Entries hold two dense
+        agents x agents complex matrices, so only the two most recent matrices are kept (the current C and an
+        explicitly passed one); a C replaced by set_combination_matrix drops out.
+        """
+        if sparse.issparse(combination_matrix):
+            combination_matrix = combination_matrix.toarray()
+        key = _content_key(combination_matrix)
+        if key not in self._spectrum_cache:
+            if len(self._spectrum_cache) >= 2:
+                self._spectrum_cache.pop(next(iter(self._spectrum_cache)))
+            e_values, e_vectors = np.linalg.eig(combination_matrix)
+            self._spectrum_cache[key] = (e_values, e_vectors, np.linalg.inv(e_vectors))
+        return self._spectrum_cache[key]
+
+    def _scaled_kl(self, state_0, state_1, multistate):
+        """
+        step_size * KL terms, cached on the content of state_true and of the likelihood (both can be replaced
+        between calls, e.g. by get_new_state).
+        """
+        key = (multistate, self.step_size, _content_key(self.state_true), _content_key(self.likelihood))
         if not multistate:
-            log = np.log(
-                self.intermediate_belief_history[time][state_0, :] / \
-                self.intermediate_belief_history[time][state_1, :]
-            )
-            log = log.reshape(-1, 1)
-        else:
-            log = np.array([np.log(
-                self.intermediate_belief_history[time][0, :] / \
-                self.intermediate_belief_history[time][n, :]) for n in range(1, self.states)
-            ]).T
-        return log
+            key += (_content_key(state_0), _content_key(state_1))
+        if key not in self._kl_cache:
+            kl = self.get_log_likelihood_expectation(state_0, state_1, self.state_true, multistate)
+            if self.step_size:
+                kl = self.step_size * kl
+            if len(self._kl_cache) >= 16:
+                self._kl_cache.pop(next(iter(self._kl_cache)))
+            self._kl_cache[key] = kl
+        return self._kl_cache[key]
 
     def get_log_belief_expectation(self, time, state_0, state_1, combination_matrix=None, multistate=False):
-        kl = self.get_log_likelihood_expectation(state_0, state_1, self.state_true, multistate)
+        """
+        sum_{i<time-1} (A^i).T @ kl with A = (1 - step_size) C, evaluated in closed form on the eigenvalues of C.
+        :int time: iteration, np.inf for the steady state (requires step_size)
+        """
+        kl = self._scaled_kl(state_0, state_1, multistate)
         if combination_matrix is None:
             combination_matrix = self.C
+        e_values, e_vectors, e_vectors_inv = self._spectrum(combination_matrix)
         if self.step_size:
-            combination_matrix = (1-self.step_size)*combination_matrix
-            kl = self.step_size * kl
-        if time == 1:
-            return np.zeros_like(kl)
+            e_values = (1-self.step_size)*e_values
 
-        res = np.zeros_like(kl)
-        comb_pow = np.eye(combination_matrix.shape[0], combination_matrix.shape[1])
-        for i in range(1, time):
-            res += comb_pow.T @ kl
-            comb_pow = combination_matrix @ comb_pow
-        return res
+        # A.T = V^-T diag(e) V^T
+        res = e_vectors_inv.T @ (_geometric_sum(e_values, max(time - 1, 0))[:, None] * (e_vectors.T @ kl))
+        return res.real
 
     def get_log_belief_r0(self, time, state_0, state_1, combination_matrix=None, multistate=False):
+        """
+        sum_{t<time} A^t Q (A^t).T with A = (1 - step_size) C, evaluated in closed form on the eigenvalues of C.
+        :int time: iteration, np.inf for the steady state (requires step_size)
+        """
         if combination_matrix is None:
             combination_matrix = self.C
-        kl = self.get_log_likelihood_expectation(state_0, state_1, self.state_true, multistate)
+        kl = self._scaled_kl(state_0, state_1, multistate)
+        e_values, e_vectors, e_vectors_inv = self._spectrum(combination_matrix)
+        if sparse.issparse(combination_matrix):
+            combination_matrix = combination_matrix.toarray()
         if self.step_size:
             combination_matrix = (1-self.step_size)*combination_matrix
-            kl = self.step_size * kl
+            e_values = (1-self.step_size)*e_values
         log_exp = self.get_log_belief_expectation(time, state_0, state_1, None, multistate)
 
-        Q = combination_matrix.T @ log_exp @ kl.T + kl @ log_exp.T @ combination_matrix + kl @ kl.T
-        comb_pow = np.eye(combination_matrix.shape[0], combination_matrix.shape[1])
-        R0 = np.zeros_like(Q)
-        for t in range(time):
-            R0 += comb_pow @ Q @ comb_pow.T
-            comb_pow = combination_matrix @ comb_pow
-        return R0
+        # Q = P kl.T + kl P.T + kl kl.T with P = A.T @ log_exp, so V^-1 Q V^-T is built from N x states factors
+        p = e_vectors_inv @ (combination_matrix.T @ log_exp)
+        k = e_vectors_inv @ kl
+        M = p @ k.T + k @ p.T + k @ k.T
+        G = _geometric_sum(e_values[:, None] * e_values[None, :], time)
+        R0 = e_vectors @ (M * G) @ e_vectors.T
+        return R0.real
 
     def get_log_likelihood_expectation(self, state_0=None, state_1=None, state_true=None, multistate=False):
+        option = 2 if self.generator.strategy == 2 else 0
         if not multistate:
-            div = kl_divergence(self.likelihood, state_true, state_1, option=0, state_true=state_true) - \
-                  kl_divergence(self.likelihood, state_true, state_0, option=0, state_true=state_true)
+            div = kl_divergence(self.likelihood, state_0, state_1, option=option, state_true=state_true)
             div = div.reshape(-1, 1)
         else:
-            div = np.array([
-                kl_divergence(self.likelihood, state_true[n], n, option=0, state_true=state_true) - \
-                kl_divergence(self.likelihood, state_true[n], 0, option=0, state_true=state_true) \
-                for n in range(1, self.states)
-            ]).T
-        return div
\ No newline at end of file
+            divergence = kl_divergence_tensor(self.likelihood, option)
+            divergence = divergence[np.arange(self.agents), np.broadcast_to(state_true, self.agents)]
+            div = divergence[:, 1:] - divergence[:, :1]
+        return div
+
+
+class BatchedNetwork(Network):
+    def __init__(self, runs, agents, states, state_true, adjacency_matrix, combination_weights, likelihood, generator,
+                 belief_init, step_size=None, window=None, beta=None, writer=None, block=None, history=True,
+                 profile=False, inplace=False, dtype=None, log_ratios=False):
+        """
+        Independent Monte Carlo runs of the same network stepped together.
+        Beliefs are kept as runs x states x agents arrays; run r at every step uses row r of
+        generator.sample(runs). With a generator built on spawn_rngs(seed, runs), run r draws its own stream and
+        its trajectory matches a Network whose Generator uses spawn_rngs(seed, runs)[r]; with a single shared
+        stream only runs=1 matches Network under the same seed.
+
+        :int runs: number of independent runs
+        :np.array belief_init: states x agents (shared by all runs) or runs x states x agents
+        """
+        rng = getattr(generator, 'rng', None)
+        if isinstance(rng, (list, tuple)) and len(rng) != runs:
+            raise ValueError("Invalid number of runs for the per-run generators.")
+        self.runs = runs
+        belief_init = np.broadcast_to(belief_init, (runs, states, agents)).copy()
+        super().__init__(agents, states, state_true, adjacency_matrix, combination_weights, likelihood, generator,
+                         belief_init, step_size=step_size, window=window, beta=beta, writer=writer, block=block,
+                         history=history, profile=profile, inplace=inplace, dtype=dtype,
+                         log_ratios=log_ratios)
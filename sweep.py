@@ -0,0 +1,80 @@
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from optimization import log_belief_ratios
+
+
+def product_grid(**axes):
+    """
+    product_grid(step_size=[None, 0.1], p=[0.1, 0.2]) -> [{'step_size': None, 'p': 0.1}, ...]
+    :return: list of dicts, one per point of the cartesian product of the axes
+    """
+    keys = list(axes)
+    return [dict(zip(keys, values)) for values in itertools.product(*axes.values())]
+
+
+def _simulate(task):
+    setup, params, times, seed = task
+    rng = np.random.default_rng(seed)
+    network = setup(params, rng)
+    for _ in range(times):
+        network.step()
+    belief_history = np.asarray(network.belief_history)[-(times + 1):]
+    state_true = np.broadcast_to(network.state_true, network.agents)
+    errors = np.argmax(belief_history, 1) != state_true[None, :]
+    return log_belief_ratios(belief_history), errors
+
+
+def run_sweep(setup, grid, runs, times, seed=0, workers=None, quantiles=(.05, .5, .95), chunksize=1):
+    """
+    Monte Carlo runs for every grid point, fanned out over a process pool.
+    Every (grid point, run) task gets its own np.random.Generator spawned from SeedSequence(seed), and results
+    are aggregated in task order as they stream back, so the output does not depend on the number of workers.
+
+    :callable setup: setup(params, rng) -> Network, a module-level function; every random draw (graph,
+        likelihoods, Generator(..., rng=rng)) has to use rng. The network must keep at least times + 1 beliefs
+    :list grid: picklable parameters for setup, one per grid point (e.g. from product_grid)
+    :int runs: Monte Carlo runs per grid point
+    :int times: steps per run
+    :int seed: root seed
+    :int workers: number of processes, None for all cores, 0 or 1 to run in this process
+    :tuple quantiles: quantiles of the log-belief ratios across runs
+    :return: list with a dict per grid point:
+        'params': grid point,
+        'mean': np.array(times + 1, agents, states - 1) mean of log(belief[0] / belief[n]) across runs,
+        'quantiles': np.array(len(quantiles), times + 1, agents, states - 1),
+        'error_rate': np.array(times + 1, agents) fraction of runs whose belief argmax is not the true state
+    """
+    seeds = [sequence.spawn(runs) for sequence in np.random.SeedSequence(seed).spawn(len(grid))]
+    tasks = ((setup, params, times, seeds[point][run]) for point, params in enumerate(grid) for run in range(runs))
+
+    if workers in (0, 1):
+        executor = None
+        results = map(_simulate, tasks)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(_simulate, tasks, chunksize=chunksize)
+
+    summary = []
+    try:
+        for params in grid:
+            log_beliefs, errors = None, None
+            for run in range(runs):
+                log_belief, error = next(results)
+                if log_beliefs is None:
+                    log_beliefs = np.empty((runs,) + log_belief.shape)
+                    errors = np.zeros(error.shape)
+                log_beliefs[run] = log_belief
+                errors += error
+            summary.append({
+                'params': params,
+                'mean': log_beliefs.mean(0),
+                'quantiles': np.quantile(log_beliefs, quantiles, axis=0),
+                'error_rate': errors / runs,
+            })
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return summary
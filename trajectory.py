@@ -0,0 +1,83 @@
+import json
+
+import numpy as np
+
+
+class TrajectoryWriter():
+    def __init__(self, path, every=1, dtype=None, chunk=256):
+        """
+        Streams equally shaped frames (e.g. beliefs of every step) to disk in fixed-size chunks, so memory
+        stays flat for any run length. Frames go to a raw binary file at `path`, the shape, dtype and number
+        of frames written so far to `path`.json, which is updated after every chunk.
+
+        :str path: data file, overwritten if it exists
+        :int every: decimation, keep every k-th appended frame (the first one is always kept)
+        :dtype: on-disk dtype, e.g. np.float32 to halve the size, None to keep the frame dtype
+        :int chunk: number of frames buffered in memory between writes
+        """
+        self.path = path
+        self.every = every
+        self.dtype = dtype
+        self.chunk = chunk
+        self.buffer = None
+        self.buffered = 0
+        self.count = 0
+        self.appended = 0
+        self.file = open(path, 'wb')
+
+    def append(self, frame):
+        keep = self.appended % self.every == 0
+        self.appended += 1
+        if not keep:
+            return
+        frame = np.asarray(frame)
+        if self.buffer is None:
+            dtype = frame.dtype if self.dtype is None else np.dtype(self.dtype)
+            self.buffer = np.empty((self.chunk,) + frame.shape, dtype=dtype)
+        self.buffer[self.buffered] = frame
+        self.buffered += 1
+        if self.buffered == self.chunk:
+            self.flush()
+
+    def flush(self):
+        if self.buffer is None:
+            return
+        self.file.write(self.buffer[:self.buffered].tobytes())
+        self.file.flush()
+        self.count += self.buffered
+        self.buffered = 0
+        meta = {'shape': list(self.buffer.shape[1:]), 'dtype': self.buffer.dtype.str,
+                'count': self.count, 'every': self.every}
+        with open(self.path + '.json', 'w') as f:
+            json.dump(meta, f)
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_trajectory(path, axes=None):
+    """
+    Lazily opens a trajectory written by TrajectoryWriter. Nothing is read until the array is indexed.
+    :str path: data file passed to TrajectoryWriter
+    :tuple axes: optional axes permutation, e.g. (1, 0, 2, 3) turns time x runs x states x agents frames
+        of a BatchedNetwork into the runs x time x states x agents layout of the notebooks
+    :return: read-only np.memmap(count, *frame_shape), or a transposed view of it
+    """
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    shape = (meta['count'],) + tuple(meta['shape'])
+    if meta['count'] == 0:
+        trajectory = np.empty(shape, dtype=meta['dtype'])
+    else:
+        trajectory = np.memmap(path, dtype=meta['dtype'], mode='r', shape=shape)
+    if axes is not None:
+        trajectory = trajectory.transpose(axes)
+    return trajectory
@@ -1,9 +1,14 @@
+import hashlib
+import warnings
+
 import numpy as np
-from sinkhorn_knopp import sinkhorn_knopp as skp
-from sklearn.cluster import KMeans
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from history import History
 
 
-def create_network(agents, option, p=0.5):
+def create_network(agents, option, p=0.5, rng=None, clusters_agents=None, probs=None):
     """
     :int agents: number of agents in the network
     :int option:
@@ -11,9 +16,20 @@ def create_network(agents, option, p=0.5):
         2:Fully connected
         3:Erdos-Renyi
         4:Star
+        7:Stochastic block model (scipy.sparse.csr_matrix with self-loops)
     :float p: probability for ER model, otherwise use 0.5
+    :rng: np.random.Generator, None for the global numpy random state
+    :list clusters_agents: cluster sizes for the SBM, summing to agents
+    :np.array probs: clusters x clusters symmetric edge probabilities for the SBM
     :return: np.array(agents, agents) adjacency matrix
     """
+    if rng is None:
+        rng = np.random
+    # Stochastic block model
+    if option == 7:
+        if clusters_agents is None or probs is None or sum(clusters_agents) != agents:
+            raise ValueError("SBM needs clusters_agents summing to agents and probs.")
+        return _stochastic_block_model(clusters_agents, probs, rng)
     # Random construction (undirected graph)
     if option == 1:
         option = 3
@@ -23,7 +39,7 @@ def create_network(agents, option, p=0.5):
         adj_matrix = np.ones((agents, agents))
     # Erdos-Renyi
     elif option == 3:
-        adj_matrix = np.random.rand(agents, agents)
+        adj_matrix = rng.random((agents, agents))
         adj_matrix[adj_matrix < 1 - p] = 0
         adj_matrix[adj_matrix >= 1 - p] = 1
         # Symmetrization
@@ -68,8 +84,100 @@ def create_network(agents, option, p=0.5):
     return adj_matrix
 
 
-def perturbe_network(adj_matrix, p_change=0.05):
-    change = np.random.rand(adj_matrix.shape[0], adj_matrix.shape[1])
+def _bernoulli_positions(cells, p, rng):
+    """
+    Indices of the successes among `cells` independent Bernoulli(p) trials, drawn by geometric skipping
+    in time proportional to the number of successes.
+    """
+    if p <= 0 or cells == 0:
+        return np.zeros(0, dtype=np.int64)
+    if p >= 1:
+        return np.arange(cells, dtype=np.int64)
+    positions = []
+    last = -1
+    while True:
+        expected = (cells - last) * p
+        gaps = rng.geometric(p, size=int(expected + 5 * np.sqrt(expected) + 10))
+        block = last + np.cumsum(gaps)
+        positions.append(block[block < cells])
+        if block[-1] >= cells:
+            break
+        last = block[-1]
+    return np.concatenate(positions)
+
+
+def _stochastic_block_model(clusters_agents, probs, rng):
+    offsets = np.concatenate(([0], np.cumsum(clusters_agents)))
+    agents = offsets[-1]
+    rows, cols = [], []
+    for a, size_a in enumerate(clusters_agents):
+        for b in range(a, len(clusters_agents)):
+            size_b = clusters_agents[b]
+            positions = _bernoulli_positions(size_a * size_b, probs[a][b], rng)
+            row, col = positions // size_b, positions % size_b
+            if a == b:
+                keep = row < col
+                row, col = row[keep], col[keep]
+            rows.append(row + offsets[a])
+            cols.append(col + offsets[b])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    diagonal = np.arange(agents)
+    rows, cols = np.concatenate((rows, cols, diagonal)), np.concatenate((cols, rows, diagonal))
+    return sparse.csr_matrix((np.ones(rows.shape[0]), (rows, cols)), shape=(agents, agents))
+
+
+def cluster_state_true(clusters_agents, clusters_states):
+    """
+    :list clusters_agents: cluster sizes
+    :list clusters_states: true state of each cluster
+    :return: np.array(agents) true state of every agent, clusters laid out consecutively as in the SBM
+    """
+    return np.repeat(np.asarray(clusters_states, dtype=int), clusters_agents)
+
+
+def sample_edge_flips(agents, p_change=0.05, rng=None):
+    """
+    Undirected pairs i > j toggled by perturbe_network, every pair independently with probability p_change,
+    drawn by geometric skipping in time proportional to the number of flips.
+    :rng: np.random.Generator, None for the global numpy random state
+    :return: np.array rows, np.array cols with rows > cols
+    """
+    if rng is None:
+        rng = np.random
+    positions = _bernoulli_positions(agents * (agents - 1) // 2, p_change, rng)
+    # pair (i, j) has position i (i - 1) / 2 + j, invert the triangular numbers and fix float rounding
+    rows = np.floor((1 + np.sqrt(1 + 8. * positions)) / 2).astype(np.int64)
+    rows -= rows * (rows - 1) // 2 > positions
+    rows += (rows + 1) * rows // 2 <= positions
+    cols = positions - rows * (rows - 1) // 2
+    return rows, cols
+
+
+def flip_edges(adj_matrix, rows, cols):
+    """
+    Toggles the entries (rows[k], cols[k]) of a 0/1 adjacency matrix, pass both directions for undirected edges.
+    :adj_matrix: np.array or scipy.sparse matrix, sparse input costs O(nnz + flips) and is never densified
+    :return: new adjacency matrix of the same kind
+    """
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    if sparse.issparse(adj_matrix):
+        present = np.asarray(adj_matrix.tocsr()[rows, cols]).reshape(-1) != 0
+        change = sparse.csr_matrix((np.where(present, -1., 1.), (rows, cols)), shape=adj_matrix.shape)
+        res = (adj_matrix.tocsr() + change).astype(adj_matrix.dtype)
+        res.eliminate_zeros()
+        return res.asformat(adj_matrix.format)
+    adj_matrix = adj_matrix.copy()
+    adj_matrix[rows, cols] = adj_matrix[rows, cols] == 0
+    return adj_matrix
+
+
+def perturbe_network(adj_matrix, p_change=0.05, rng=None):
+    if rng is None:
+        rng = np.random
+    if sparse.issparse(adj_matrix):
+        rows, cols = sample_edge_flips(adj_matrix.shape[0], p_change, rng)
+        return flip_edges(adj_matrix, np.concatenate((rows, cols)), np.concatenate((cols, rows)))
+    change = rng.random((adj_matrix.shape[0], adj_matrix.shape[1]))
     change[change<1-p_change] = 0
     change[change>0] = 1
     change = np.tril(change, 1)
@@ -81,37 +189,285 @@ def perturbe_network(adj_matrix, p_change=0.05):
     return adj_matrix
 
 
-def generate_combination_weights(adj_matrix, option):
+def _normalize_columns(matrix):
+    if sparse.issparse(matrix):
+        return matrix @ sparse.diags(1 / np.asarray(matrix.sum(0)).reshape(-1))
+    return matrix / matrix.sum(0)[None, :]
+
+
+def _is_symmetric(matrix):
+    if sparse.issparse(matrix):
+        return (matrix != matrix.T).nnz == 0
+    return np.array_equal(matrix, matrix.T)
+
+
+def sinkhorn_balance(matrix, tol=1e-3, max_iter=1000):
+    """
+    Sinkhorn-Knopp balancing diag(r) matrix diag(c) into a doubly stochastic matrix, with matrix-vector
+    products only, so sparse input stays sparse.
+    :matrix: agents x agents non-negative np.array or scipy.sparse matrix with total support
+    :float tol: stop once all row and column sums are within tol of 1
+    :int max_iter: maximal number of iterations
+    :return: doubly stochastic matrix of the same kind as the input
+    """
+    r = np.ones(matrix.shape[0])
+    c = np.ones(matrix.shape[1])
+    for _ in range(max_iter):
+        c = 1 / (matrix.T @ r)
+        r = 1 / (matrix @ c)
+        # rows sum to 1 exactly after the r update, columns sum to c * (matrix.T @ r)
+        if np.all(np.abs(c * (matrix.T @ r) - 1) <= tol):
+            break
+    if sparse.issparse(matrix):
+        return sparse.diags(r) @ matrix @ sparse.diags(c)
+    return r[:, None] * matrix * c[None, :]
+
+
+def perron_vector(matrix, tol=1e-10, max_iter=100000, init=None):
     """
-    :np.array adj_matrix:
+    Right Perron eigenvector of a left-stochastic matrix (matrix @ p = p, p sums to 1) by lazy power iteration
+    p <- (p + matrix @ p) / 2, which converges on periodic graphs as well. Only matrix-vector products,
+    so sparse input is never densified.
+    :matrix: agents x agents np.array or scipy.sparse matrix
+    :float tol: stop once the l1 residual ||matrix @ p - p|| falls below tol
+    :int max_iter: maximal number of iterations, a RuntimeWarning is issued if the residual is still above tol
+    :np.array init: warm start, e.g. the previous centrality of a slightly changed graph, uniform if None
+    :return: np.array(agents) centrality
+    """
+    agents = matrix.shape[0]
+    p = np.ones(agents) / agents if init is None else np.asarray(init, dtype=float) / np.sum(init)
+    for _ in range(max_iter):
+        product = matrix @ p
+        residual = np.abs(product - p).sum()
+        if residual < tol:
+            return p
+        p = .5 * (p + product)
+        p /= p.sum()
+    warnings.warn("perron_vector did not converge in {} iterations (residual {:.1e}, tol {:.1e}).".format(
+        max_iter, residual, tol), RuntimeWarning)
+    return p
+
+
+def generate_combination_weights(adj_matrix, option, tol=1e-10, rng=None):
+    """
+    :adj_matrix: np.array or scipy.sparse matrix (never densified)
     :int option:
         0:Uniform
         1:Doubly stochastic
         2:Random (Left stochastic)
+    :float tol: tolerance of the Perron vector iteration
+    :rng: np.random.Generator for option 2, None for the global numpy random state
     :return: np.array combination_weights, np.array centrality, bool strongly_connected
+        (combination_weights keeps the scipy.sparse format of a sparse adj_matrix)
     """
-    weight = adj_matrix.copy()
+    if rng is None:
+        rng = np.random
+    if sparse.issparse(adj_matrix):
+        weight = sparse.csc_matrix(adj_matrix, dtype=float)
+        weight.eliminate_zeros()
+    else:
+        weight = np.array(adj_matrix, dtype=float)
+    adjacency = weight
     # Uniform
     if option == 0:
-        weight = weight / weight.sum(0)[None, :]
-    elif option == 1:
-        sk = skp.SinkhornKnopp()
-        weight = sk.fit(weight)
+        weight = _normalize_columns(weight)
     elif option == 1:
-        weight = np.random.uniform(size=weight.shape)
-        weight[adj_matrix == 0] = 0
-        weight = weight / weight.sum(0)[None, :]
+        weight = sinkhorn_balance(weight)
+    elif option == 2:
+        if sparse.issparse(weight):
+            weight = weight.copy()
+            weight.data = rng.uniform(size=weight.nnz)
+        else:
+            weight = rng.uniform(size=weight.shape)
+            weight[adjacency == 0] = 0
+        weight = _normalize_columns(weight)
     else:
-        print("Invalid selection of the option.")
+        raise ValueError("Invalid selection of the option.")
 
-    e_values, e_vectors = np.linalg.eig(weight)
-    e_index = np.argmax(e_values)
-    centrality = e_vectors[:, e_index] / e_vectors[:, e_index].sum()
-    strongly_connected = np.all(centrality > 0)
+    if option == 0 and _is_symmetric(adjacency):
+        # A D^-1 d = A 1 = d for undirected graphs, the centrality is the normalised degree
+        degree = np.asarray(adjacency.sum(0)).reshape(-1)
+        centrality = degree / degree.sum()
+    else:
+        centrality = perron_vector(weight, tol=tol)
+    components, _ = connected_components(adjacency, directed=True, connection='strong')
+    strongly_connected = components == 1
+    if sparse.issparse(adj_matrix):
+        weight = weight.asformat(adj_matrix.format)
     return weight, centrality, strongly_connected
 
 
-def create_likelihoods(agents, states, strategy, params=2, max_mean=10., max_std=3., var=.1, num_inf=3, state_true=None):
+def _csc_find(matrix, rows, cols):
+    """
+    Positions of the entries (rows[k], cols[k]) in a CSC matrix with sorted indices, by a binary search inside
+    each column: the first stored row >= rows[k] in column cols[k], and whether it is rows[k] itself.
+    """
+    start, end = matrix.indptr[cols].astype(np.int64), matrix.indptr[cols + 1].astype(np.int64)
+    low, high = start.copy(), end.copy()
+    while True:
+        active = np.flatnonzero(low < high)
+        if active.shape[0] == 0:
+            break
+        middle = (low[active] + high[active]) // 2
+        less = matrix.indices[middle] < rows[active]
+        low[active[less]] = middle[less] + 1
+        high[active[~less]] = middle[~less]
+    if matrix.nnz == 0:
+        return low, np.zeros(rows.shape[0], dtype=bool)
+    present = (low < end) & (matrix.indices[np.minimum(low, matrix.nnz - 1)] == rows)
+    return low, present
+
+
+class DynamicGraph():
+    def __init__(self, adj_matrix, option=0, tol=1e-10, rng=None):
+        """
+        Combination weights of a graph whose edges change over time.
+        The raw edge weights (1 for uniform, uniform draws for random) and their column sums are kept, so
+        flipping edges only re-sums and renormalises the columns they end in, and the Perron vector is
+        warm-started from the previous centrality instead of being recomputed from scratch. On sparse input A,
+        the weights and C share one CSC pattern: a flip finds its entries by binary search inside their columns
+        and splices them into the arrays with one np.delete / np.insert each, which still moves the O(nnz) arrays
+        in memory (a new CSC C is returned) but does no arithmetic outside the touched columns.
+        Hand C to Network.set_combination_matrix between steps.
+
+        :adj_matrix: agents x agents np.array or scipy.sparse matrix (kept as CSC, never densified)
+        :int option:
+            0:Uniform
+            2:Random (Left stochastic)
+        :float tol: tolerance of the Perron vector iteration
+        :rng: np.random.Generator for the flips and the random weights, None for the global numpy random state
+        """
+        self.rng = np.random if rng is None else rng
+        self.option = option
+        self.tol = tol
+        self.agents = adj_matrix.shape[0]
+        if sparse.issparse(adj_matrix):
+            self.A = sparse.csc_matrix(adj_matrix, dtype=float)
+            self.A.eliminate_zeros()
+            self.A.sort_indices()
+        else:
+            self.A = np.array(adj_matrix, dtype=float)
+        if option == 0:
+            self.weight = self.A.copy()
+        elif option == 2:
+            if sparse.issparse(self.A):
+                self.weight = self.A.copy()
+                self.weight.data = self.rng.uniform(size=self.weight.nnz)
+            else:
+                self.weight = self.rng.uniform(size=self.A.shape)
+                self.weight[self.A == 0] = 0
+        else:
+            raise ValueError("Invalid selection of the option.")
+        self.column_sum = np.zeros(self.agents)
+        self.symmetric = _is_symmetric(self.A)
+        self.C = self.weight.copy() if sparse.issparse(self.weight) else None
+        self._rescale(np.arange(self.agents))
+        self.centrality = None
+        self._update_centrality()
+
+    def _rescale(self, columns):
+        if sparse.issparse(self.weight):
+            # entries of the touched columns only
+            start = self.weight.indptr[columns].astype(np.int64)
+            length = self.weight.indptr[columns + 1] - start
+            owner = np.repeat(np.arange(columns.shape[0]), length)
+            entries = np.arange(owner.shape[0]) + np.repeat(start - np.cumsum(length) + length, length)
+            weight = self.weight.data[entries]
+            self.column_sum[columns] = np.bincount(owner, weights=weight, minlength=columns.shape[0])
+            self.C.data[entries] = weight / self.column_sum[columns][owner]
+        else:
+            self.column_sum[columns] = self.weight[:, columns].sum(0)
+            if self.C is None:
+                self.C = np.zeros_like(self.weight)
+            self.C[:, columns] = self.weight[:, columns] / self.column_sum[columns]
+
+    def _update_centrality(self):
+        if self.option == 0 and self.symmetric:
+            # the normalised degree, as in generate_combination_weights
+            self.centrality = self.column_sum / self.column_sum.sum()
+        else:
+            self.centrality = perron_vector(self.C, tol=self.tol, init=self.centrality)
+
+    def flip(self, rows, cols):
+        """
+        Toggles the distinct edges (rows[k], cols[k]), pass both directions for undirected edges.
+        A dense C is updated in place, column by column; a sparse C is spliced into new CSC arrays.
+        :return: combination matrix, centrality
+        """
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        if sparse.issparse(self.A):
+            position, present = _csc_find(self.A, rows, cols)
+        else:
+            present = self.A[rows, cols] != 0
+        if self.option == 0:
+            weight = np.ones(rows.shape[0])
+        else:
+            weight = self.rng.uniform(size=rows.shape[0])
+        if sparse.issparse(self.A):
+            self._splice(position, present, rows, cols, weight)
+        else:
+            self.A[rows, cols] = ~present
+            self.weight[rows, cols] = np.where(present, 0, weight)
+        if self.symmetric:
+            self.symmetric = np.array_equal(np.sort(rows * self.agents + cols), np.sort(cols * self.agents + rows))
+        self._rescale(np.unique(cols))
+        self._update_centrality()
+        return self.C, self.centrality
+
+    def _splice(self, position, present, rows, cols, weight):
+        removed = np.sort(position[present])
+        added = np.flatnonzero(~present)
+        added = added[np.lexsort((rows[added], cols[added], position[added]))]
+        # insertion points once the removed entries are gone, rows in increasing order inside every column
+        inserted = position[added] - np.searchsorted(removed, position[added])
+        counts = np.diff(self.A.indptr) + np.bincount(cols[added], minlength=self.agents) - \
+            np.bincount(cols[present], minlength=self.agents)
+        indptr = np.concatenate(([0], np.cumsum(counts))).astype(self.A.indptr.dtype)
+        indices = np.insert(np.delete(self.A.indices, removed), inserted, rows[added]).astype(self.A.indices.dtype)
+
+        def splice(data, values):
+            matrix = sparse.csc_matrix((np.insert(np.delete(data, removed), inserted, values), indices, indptr),
+                                       shape=self.A.shape, copy=False)
+            matrix.has_sorted_indices = True
+            return matrix
+        self.A = splice(self.A.data, 1.)
+        self.weight = splice(self.weight.data, weight[added])
+        self.C = splice(self.C.data, 0.)
+
+    def perturbe(self, p_change=0.05):
+        """
+        Sparse counterpart of perturbe_network: every undirected pair i != j flips with probability p_change.
+        :return: combination matrix, centrality
+        """
+        rows, cols = sample_edge_flips(self.agents, p_change, self.rng)
+        return self.flip(np.concatenate((rows, cols)), np.concatenate((cols, rows)))
+
+    def strongly_connected(self):
+        components, _ = connected_components(self.A, directed=True, connection='strong')
+        return components == 1
+
+
+def log_combine(log_belief, combination_matrix, out=None):
+    """
+    Geometric combination over neighbours, combination_matrix.T @ log_belief[state] for every state.
+    :np.array log_belief: (..., states, agents)
+    :combination_matrix: agents x agents np.array or scipy.sparse matrix, or a block of its columns
+    :np.array out: optional output buffer of the result shape, written without a temporary for dense matrices
+    :return: np.array(..., states, combination_matrix.shape[1])
+    """
+    if sparse.issparse(combination_matrix):
+        shape = log_belief.shape[:-1] + (combination_matrix.shape[1],)
+        log_belief = log_belief.reshape(-1, log_belief.shape[-1])
+        res = np.asarray(combination_matrix.T @ log_belief.T).T.reshape(shape)
+        if out is None:
+            return res
+        out[...] = res
+        return out
+    return np.matmul(log_belief, combination_matrix, out=out)
+
+
+def create_likelihoods(agents, states, strategy, params=2, max_mean=10., max_std=3., var=.1, num_inf=3, state_true=None,
+                       rng=None):
     """
     :int agents: number of agents in the network
     :int states: number of states in the network
@@ -121,19 +477,22 @@ def create_likelihoods(agents, states, strategy, params=2, max_mean=10., max_std
         2:gaussian
         3:discrete manual with influencers
     :int params: number of different discrete states for 0 strategy
+    :rng: np.random.Generator, None for the global numpy random state
     :return: np.array(agents, states, params) likelihood matrix
     """
+    if rng is None:
+        rng = np.random
     if strategy == 0:
-        probabilities = np.random.rand(agents, params)
-        random_error = var * np.random.rand(agents, states, params)
+        probabilities = rng.random((agents, params))
+        random_error = var * rng.random((agents, states, params))
         likelihood_matrix = np.repeat(probabilities[:, np.newaxis, :], states, axis=1) + random_error
         likelihood_matrix = likelihood_matrix / likelihood_matrix.sum(2)[:, :, None]
     elif strategy == 1:
-        likelihood_matrix = np.random.rand(agents, states, params)
+        likelihood_matrix = rng.random((agents, states, params))
         likelihood_matrix = likelihood_matrix / likelihood_matrix.sum(2)[:, :, None]
     elif strategy == 2:
         params = 2
-        likelihood_matrix = np.random.rand(agents, states, params)
+        likelihood_matrix = rng.random((agents, states, params))
         likelihood_matrix[:, :, 0] *= max_mean
         likelihood_matrix[:, :, 1] *= max_std
         likelihood_matrix = likelihood_matrix / likelihood_matrix.sum(2)[:, :, None]
@@ -179,93 +538,180 @@ def create_likelihoods(agents, states, strategy, params=2, max_mean=10., max_std
 
 
 class Generator():
-    def __init__(self, likelihood_matrix, state_true, strategy):
+    def __init__(self, likelihood_matrix, state_true, strategy, rng=None):
         """
         :np.array likelihood_matrix: likelihood matrix of size agents x states x params
         :int state_true: true distributions state
         :int strategy:
             0, 1:discrete
             2:gaussian
+        :rng: np.random.Generator, None for the global numpy random state, or a list with a np.random.Generator
+            per run (see spawn_rngs) so that run r of sample(runs) draws the same stream as a single-run
+            Generator built with rng[r]
         """
+        self.rng = np.random if rng is None else rng
         self.likelihood_matrix = likelihood_matrix
-        self.state_true = state_true
-        if isinstance(self.state_true, int):
-            self.state_true = self.state_true * np.ones(self.likelihood_matrix.shape[0])
-            self.state_true = self.state_true.astype(int)
         self.strategy = strategy
         if strategy not in {0, 1, 2}:
             raise ValueError("Invalid selection of the strategy.")
+        self.version = 0
+        self.state_true = state_true
+
+    @property
+    def state_true(self):
+        return self._state_true
 
-    def sample(self):
+    @state_true.setter
+    def state_true(self, state_true):
         """
-        :return: np.array(agents) sample
+        Changing the true state rebuilds the sampling tables and bumps version, which tells networks to drop
+        observations they have buffered with sample_block.
         """
-        agents, states, params = self.likelihood_matrix.shape
+        if isinstance(state_true, int):
+            state_true = state_true * np.ones(self.likelihood_matrix.shape[0])
+            state_true = state_true.astype(int)
+        self._state_true = state_true
+        self._build_tables()
+        self.version += 1
+
+    def _build_tables(self):
+        agents = self.likelihood_matrix.shape[0]
+        likelihood_true = self.likelihood_matrix[np.arange(agents), self._state_true, :]
+        if (self.strategy == 0) or (self.strategy == 1):
+            self.cdf = np.cumsum(likelihood_true, axis=1)  # agents x params
+            self._cdf_flat = self.cdf.ravel()
+            self._cdf_row = np.arange(agents) * self.cdf.shape[1]  # offset of every agent's row in _cdf_flat
+        elif self.strategy == 2:
+            self.mean = likelihood_true[:, 0].copy()
+            self.std = likelihood_true[:, 1].copy()
+
+    def _random(self, method, size):
+        if not isinstance(self.rng, (list, tuple)):
+            return getattr(self.rng, method)(size=size)
+        # one stream per run, the runs axis is the one before the agents axis
+        size = np.atleast_1d(size).tolist()
+        if len(size) < 2 or size[-2] != len(self.rng):
+            raise ValueError("Invalid number of runs for the per-run generators.")
+        shape = tuple(size[:-2] + size[-1:])
+        return np.stack([getattr(rng, method)(size=shape) for rng in self.rng], axis=-2)
+
+    def _draw(self, size):
         if (self.strategy == 0) or (self.strategy == 1):
-            cumsum = np.cumsum(self.likelihood_matrix[np.arange(agents), self.state_true, :], axis=1)
-            uniform = np.random.uniform(size=agents)
-            sample = np.argmax(cumsum >= uniform[:, None], 1)
+            uniform = self._random('uniform', size)
+            sample = self._inverse_cdf(uniform)
         elif self.strategy == 2:
-            sample = np.random.normal(size=agents)
-            mean = self.likelihood_matrix[np.arange(agents), self.state_true, 0]
-            std = self.likelihood_matrix[np.arange(agents), self.state_true, 1]
-            sample = mean * sample + std
+            sample = self._random('normal', size)
+            sample = self.mean * sample + self.std
         return sample
 
+    def _inverse_cdf(self, uniform):
+        """
+        First index with cdf >= uniform for every agent (the last axis), 0 if there is none, as
+        np.argmax(cdf >= uniform[..., None], -1) but by a branchless binary search on the rows of the flattened cdf:
+        log2(params) gathers per draw and no (..., agents, params) temporary.
+        """
+        params = self.cdf.shape[1]
+        index = np.broadcast_to(self._cdf_row, uniform.shape).copy()
+        length = params
+        while length > 1:
+            half = length // 2
+            index += half * (self._cdf_flat[index + (half - 1)] < uniform)
+            length -= half
+        index += self._cdf_flat[index] < uniform
+        index -= self._cdf_row
+        index[index == params] = 0
+        return index
+
+    def sample(self, runs=None):
+        """
+        :int runs: number of independent runs to sample at once, None for a single run
+        :return: np.array(agents) sample, or np.array(runs, agents) if runs is given
+        """
+        agents = self.likelihood_matrix.shape[0]
+        return self._draw(agents if runs is None else (runs, agents))
 
-def kl_divergence(likelihood, state_0, state_1, option, state_true=None):
+    def sample_block(self, times, runs=None):
+        """
+        Observations of `times` consecutive steps in one vectorised draw. The random stream is consumed in the
+        same order as `times` calls of sample(runs), so both give identical observations.
+        :int times: number of steps
+        :int runs: number of independent runs, None for a single run
+        :return: np.array(times, agents) or np.array(times, runs, agents)
+        """
+        agents = self.likelihood_matrix.shape[0]
+        return self._draw((times, agents) if runs is None else (times, runs, agents))
+
+
+def spawn_rngs(seed, runs):
+    """
+    Independent streams for the runs of a BatchedNetwork, children of np.random.SeedSequence(seed).
+    :return: list of np.random.Generator, the r-th one is np.random.default_rng(SeedSequence(seed).spawn(runs)[r])
     """
+    return [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(runs)]
+
+
+_kl_tensor_cache = {}
+
 
-    :param likelihood:
-    :param state_0:
-    :param state_1:
+def kl_divergence_tensor(likelihood, option):
+    """
+    All-pairs KL divergences, memoised on the content of the likelihood array.
+    :np.array likelihood: agents x states x params
     :int option:
         0, 1:multinomial
-        2: gaussian
-    :return:
+        2:gaussian, params are (mu, sigma)
+    :return: np.array(agents, states, states), [k, i, j] = KL(likelihood[k, i] || likelihood[k, j])
     """
-
-    agents = likelihood.shape[0]
-    if state_true is None:
-        state_true = np.array([state_0]*agents)
-
-    def helper_0(params_0, params_1):
-        return np.sum(params_0 * np.log(params_0 / params_1))
-    
-    def helper_2(params_0, params_1):
-        return params_1[1]/params_0[1] + (params_0[1]**2 + (params_0[0]-params_1[0])**2)/(2*params_1[1]**2)
-        # log sigma2/sigma1 + (sigma1^2 + (mu1-mu2)^2)/(2sigma2^2)
-
-    agents, _, _ = likelihood.shape
-    # not efficient
-    if option == 0 or 1:
-        divergence = np.zeros(agents)
-        likelihood_0 = likelihood[:, state_0, :]  # agents x parameters
-        likelihood_1 = likelihood[:, state_1, :]
-        likelihood_true = likelihood[np.arange(agents), state_true, :]
-        # likelihood_true = np.zeros_like(likelihood_0)
-        # for agent, state in zip(range(agents), state_true):
-        #     likelihood_true[agent] = likelihood[agent, state, :]
-        for agent in range(agents):
-            divergence[agent] = helper_0(likelihood_true[agent, :], likelihood_1[agent, :]) \
-                - helper_0(likelihood_true[agent, :], likelihood_0[agent, :])
+    likelihood = np.ascontiguousarray(likelihood, dtype=float)
+    key = (likelihood.shape, option, hashlib.sha1(likelihood).hexdigest())
+    if key in _kl_tensor_cache:
+        return _kl_tensor_cache[key]
+
+    if option in (0, 1):
+        log_likelihood = np.log(likelihood)
+        entropy = (likelihood * log_likelihood).sum(2)  # agents x states
+        divergence = entropy[:, :, None] - np.einsum('kip,kjp->kij', likelihood, log_likelihood)
     elif option == 2:
-        divergence = np.zeros(agents)
-        likelihood_0 = likelihood[:, state_0, :]  # agents x parameters
-        likelihood_1 = likelihood[:, state_1, :]
-        likelihood_true = likelihood[np.arange(agents), state_true, :]
-        # likelihood_true = np.zeros_like(likelihood_0)
-        # for agent, state in zip(range(agents), state_true):
-        #     likelihood_true[agent] = likelihood[agent, state, :]
-        for agent in range(agents):
-            divergence[agent] = helper_2(likelihood_true[agent, :], likelihood_1[agent, :]) \
-                - helper_2(likelihood_true[agent, :], likelihood_0[agent, :])
+        mu, sigma = likelihood[:, :, 0], likelihood[:, :, 1]
+        # log sigma2/sigma1 + (sigma1^2 + (mu1-mu2)^2)/(2sigma2^2) - 1/2
+        divergence = np.log(sigma[:, None, :] / sigma[:, :, None]) + \
+            (sigma[:, :, None]**2 + (mu[:, :, None] - mu[:, None, :])**2) / (2*sigma[:, None, :]**2) - .5
     else:
         raise ValueError("Invalid selection of the option.")
+
+    if len(_kl_tensor_cache) >= 16:
+        _kl_tensor_cache.pop(next(iter(_kl_tensor_cache)))
+    divergence.flags.writeable = False
+    _kl_tensor_cache[key] = divergence
     return divergence
 
-def random_combination_matrix_init(agents):
-    matrix = np.random.uniform(size=(agents, agents))
+
+def kl_divergence(likelihood, state_0, state_1, option, state_true=None):
+    """
+    KL(true || state_1) - KL(true || state_0) per agent, read from kl_divergence_tensor.
+    :param likelihood: agents x states x params
+    :param state_0: int or np.array(agents)
+    :param state_1: int or np.array(agents)
+    :int option:
+        0, 1:multinomial
+        2: gaussian
+    :param state_true: int or np.array(agents), state_0 if None
+    :return: np.array(agents)
+    """
+    agents = likelihood.shape[0]
+    if state_true is None:
+        state_true = state_0
+    index = np.arange(agents)
+    state_true = np.broadcast_to(state_true, agents)
+    divergence = kl_divergence_tensor(likelihood, option)
+    return divergence[index, state_true, np.broadcast_to(state_1, agents)] - \
+        divergence[index, state_true, np.broadcast_to(state_0, agents)]
+
+
+def random_combination_matrix_init(agents, rng=None):
+    if rng is None:
+        rng = np.random
+    matrix = rng.uniform(size=(agents, agents))
     matrix = .5 * (matrix + matrix.T)
     matrix = matrix / matrix.sum(0)[None, :]
     return matrix
@@ -277,47 +723,56 @@ def estimation_error(matrix_1, matrix_2):
     return np.linalg.norm(matrix_1 - matrix_2)**2
 
 
+def two_means_threshold(values, return_thresholds=False):
+    """
+    Exact 1-D 2-means split of every column (sort + prefix sums), in place of a KMeans(n_clusters=2) fit per column.
+    On centred data the within-cluster sum of squares is minimal at the split k maximising S_k^2 n / (k (n - k)),
+    with S_k the sum of the k smallest values; only splits between distinct values are admissible.
+    :np.array values: (n,) or (n, columns)
+    :bool return_thresholds: also return the per-column thresholds (midpoints between the two clusters)
+    :return: np.array of labels with the shape of values, 1 for the cluster with the larger values
+        (all 0 for a constant column), and np.array(columns) thresholds if requested
+    """
+    values = np.asarray(values, dtype=float)
+    ordered = np.sort(values, axis=0)
+    n = ordered.shape[0]
+    centred = ordered - ordered.mean(0)
+    prefix = np.cumsum(centred, axis=0)[:-1]
+    k = np.arange(1, n).reshape((-1,) + (1,) * (values.ndim - 1))
+    score = prefix**2 * n / (k * (n - k))
+    score[ordered[:-1] == ordered[1:]] = -np.inf
+    split = np.argmax(score, axis=0)[None]
+    thresholds = .5 * (np.take_along_axis(ordered, split, 0) + np.take_along_axis(ordered, split + 1, 0))[0]
+    constant = ordered[0] == ordered[-1]
+    thresholds = np.where(constant, ordered[-1], thresholds)
+    labels = (values > thresholds).astype(int)
+    if return_thresholds:
+        return labels, thresholds
+    return labels
+
+
 def estimate_adjacency(combination_matrix_learn):
-    kmeans = KMeans(n_clusters=2)
-    clusters = kmeans.fit_predict(combination_matrix_learn.reshape(-1, 1)).reshape(combination_matrix_learn.shape)
-    if kmeans.cluster_centers_[0] > kmeans.cluster_centers_[1]:
-        clusters[clusters==0] = 2
-        clusters[clusters==1] = 0
-        clusters[clusters==2] = 1
+    clusters = two_means_threshold(combination_matrix_learn.reshape(-1)).reshape(combination_matrix_learn.shape)
     np.fill_diagonal(clusters, 1.)
     return clusters
 
 
 def estimate_adjacency_colwise(combination_matrix_learn):
-    n = combination_matrix_learn.shape[0]
-    kmeans = KMeans(n_clusters=2)
-    clusters = np.zeros_like(combination_matrix_learn)
-    for col in range(n):
-        clusters_col = kmeans.fit_predict(combination_matrix_learn[:, col].reshape(-1, 1)).reshape(-1)
-        if kmeans.cluster_centers_[0] > kmeans.cluster_centers_[1]:
-            clusters_col[clusters_col==0] = 2
-            clusters_col[clusters_col==1] = 0
-            clusters_col[clusters_col==2] = 1
-        clusters[:, col] = clusters_col
+    clusters = two_means_threshold(combination_matrix_learn).astype(combination_matrix_learn.dtype)
     # sym
     clusters = np.triu(clusters, 1) + np.triu(clusters, 1).T
     np.fill_diagonal(clusters, 1.)
     return clusters
 
 
-def state_estimate(intermediate_belief, combination_matrix):
-    def belief_estimate(intermediate_belief, combination_matrix):
-        states, agents = intermediate_belief.shape
-        denominator = np.zeros(agents)
-        belief = np.zeros((states, agents))
-        for state in range(states):
-            belief[state] = np.exp(combination_matrix.T @ np.log(intermediate_belief[state, :]))
-            denominator += belief[state]
-        belief /= denominator[None, :]
-        return belief
-
-    belief = belief_estimate(intermediate_belief, combination_matrix)
-    belief_state = np.argmax(belief, 0)
+def state_estimate(intermediate_belief, combination_matrix, log=False):
+    """
+    :np.array intermediate_belief: states x agents, log-beliefs if log is set (e.g. network.log_intermediate_belief)
+    :return: majority vote over the agents of the belief argmax after one combination step
+    """
+    log_belief = intermediate_belief if log else np.log(intermediate_belief)
+    # exp and the normalisation do not move the argmax
+    belief_state = np.argmax(log_combine(log_belief, combination_matrix), 0)
     values, counts = np.unique(belief_state, return_counts=True)
     state = values[np.argmax(counts)]
     return state
@@ -333,6 +788,96 @@ def state_estimate_psi(intermediate_belief, multitask=True):
     return state
 
 
+class WindowedStateEstimator():
+    def __init__(self, states, agents, state_true, window, mean=False, delay=0):
+        """
+        Online replacement for voting over, averaging and counting errors on a window of intermediate beliefs.
+        Attached to a Network (network.attach(estimator)) it is fed every intermediate belief, and keeps
+        per-agent vote counts of the belief argmax over the last `window` steps (plus, if mean is set, the
+        running sum of the beliefs), so every update and query costs O(agents x states).
+        Only the window of argmax decisions is stored, window x agents in the smallest integer type holding a state.
+
+        :int states: number of hypotheses
+        :int agents: number of agents
+        :state_true: int or np.array(agents) true state used by error_probability
+        :int window: window length
+        :bool mean: also keep the running mean of intermediate beliefs (mean_belief, mean_estimate); this stores
+            the window of beliefs as well, window x states x agents floats
+        :int delay: number of newest beliefs held back from the window, e.g. window=499, delay=1 for the
+            entries range(-500, -1) of intermediate_belief_history
+        """
+        self.states = states
+        self.agents = agents
+        self.state_true = state_true
+        self.window = window
+        self.votes = np.zeros((states, agents), dtype=np.int64)
+        self.decision_dtype = np.min_scalar_type(states - 1)
+        self.decisions = History(window)
+        self.beliefs = History(window) if mean else None
+        self.total = np.zeros((states, agents)) if mean else None
+        self.updates = 0
+        self.delay = delay
+        self.pending = History(delay) if delay else None
+
+    def update(self, belief):
+        """
+        :np.array belief: states x agents intermediate belief of the newest step
+        """
+        if self.pending is not None:
+            # the oldest held back belief enters the window before its slot is overwritten
+            if len(self.pending) == self.delay:
+                self._push(self.pending[0])
+            self.pending.append(belief)
+        else:
+            self._push(belief)
+
+    def _push(self, belief):
+        full = len(self.decisions) == self.window
+        if full:
+            self.votes[self.decisions[0], np.arange(self.agents)] -= 1
+        decision = np.argmax(belief, 0).astype(self.decision_dtype)
+        self.decisions.append(decision)
+        self.votes[decision, np.arange(self.agents)] += 1
+        if self.beliefs is not None:
+            if full:
+                self.total -= self.beliefs[0]
+            self.beliefs.append(belief)
+            self.total += belief
+            self.updates += 1
+            if self.updates % self.window == 0:
+                # drop rounding drift of the running sum
+                self.total = self.beliefs.view().sum(0)
+
+    def estimate(self):
+        """
+        :return: np.array(agents) majority vote of the belief argmax over the window (ties to the lowest state)
+        """
+        return np.argmax(self.votes, 0)
+
+    def mean_belief(self):
+        """
+        :return: np.array(states, agents) mean intermediate belief over the window
+        """
+        if self.total is None:
+            raise ValueError("The window mean needs mean=True.")
+        return self.total / len(self.beliefs)
+
+    def mean_estimate(self):
+        """
+        :return: np.array(agents) state_estimate_psi of the window mean
+        """
+        if self.total is None:
+            raise ValueError("The window mean needs mean=True.")
+        return np.argmax(self.total, 0)
+
+    def error_probability(self):
+        """
+        :return: np.array(agents) fraction of the window in which the belief argmax is not the true state
+        """
+        state_true = np.broadcast_to(self.state_true, self.agents)
+        return 1 - self.votes[state_true, np.arange(self.agents)] / len(self.decisions)
+
+
 def state_estimate_lk(expected_likelihood, state_0):
     if state_0 != 0:
         raise ValueError("state_0 = 0.")